@@ -0,0 +1,61 @@
+"""
+Measure the per-call cost of dispatching argv lists through a CLI.
+
+Compares rebuilding the parser for every call against reusing the parser
+returned by :meth:`subparse.CLI.compile`, and against the cost of
+:meth:`argparse.ArgumentParser.parse_args` alone, with both the default
+parser and :class:`subparse.fastparse.FastArgumentParser`.
+
+Usage::
+
+    python benchmarks/bench_dispatch.py [NUM_COMMANDS]
+
+"""
+import sys
+import timeit
+
+from subparse import CLI, build_parser
+from subparse.fastparse import FastArgumentParser
+
+
+def make_cli(num_commands, parser_class=None):
+    cli = CLI(context_factory=lambda cli, args: None, parser_class=parser_class)
+
+    for i in range(num_commands):
+
+        def factory(parser):
+            """A synthetic command."""
+            parser.add_argument('--flag', action='store_true')
+            parser.add_argument('--value', default='x')
+
+        cli.add_command(factory, lambda ctx, args: 0, name=f'cmd-{i}')
+    return cli
+
+
+def bench(label, fn, number):
+    elapsed = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f'{label:<24} {elapsed * 1e6:>10.1f} us/call')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    num_commands = int(argv[0]) if argv else 100
+    number = max(10, 10000 // num_commands)
+    cli = make_cli(num_commands)
+    args = ['cmd-0', '--flag', '--value', 'y']
+
+    print(f'{num_commands} commands')
+    bench('rebuild + parse', lambda: build_parser(cli).parse_args(args), number)
+    bench('compiled run', lambda: cli.run(args), number)
+    parser = cli.compile()
+    bench('parse_args alone', lambda: parser.parse_args(args), number)
+
+    cli = make_cli(num_commands, FastArgumentParser)
+    bench('fast compiled run', lambda: cli.run(args), number)
+    parser = cli.compile()
+    bench('fast parse_args alone', lambda: parser.parse_args(args), number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure the memory used per registered command.
+
+Registers a number of generated commands, as an application creating one
+command per tenant or resource would, and reports the memory allocated per
+command (via ``tracemalloc``) after registration, after building a lazy
+parser and after rendering the top-level help.
+
+Usage::
+
+    python benchmarks/bench_registry.py [NUM_COMMANDS]
+
+"""
+import contextlib
+import io
+import sys
+import tracemalloc
+
+from subparse import CLI
+
+
+def factory(parser):
+    """
+    Manage a generated resource.
+
+    A longer description of the resource which is wrapped over
+    several lines and only needed when rendering help.
+    """
+    parser.add_argument('--flag', action='store_true')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    num_commands = int(argv[0]) if argv else 10000
+    names = [f'resource-{i}' for i in range(num_commands)]
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    cli = CLI(lazy=True)
+    for name in names:
+        cli.add_command(factory, 'myapp.main', name=name)
+    registered = tracemalloc.get_traced_memory()[0]
+    cli.compile()
+    compiled = tracemalloc.get_traced_memory()[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        with contextlib.suppress(SystemExit):
+            cli.run(['help'])
+    rendered = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{num_commands} commands')
+    for label, size in (
+        ('registered', registered - base),
+        ('compiled (lazy)', compiled - base),
+        ('after help', rendered - base),
+    ):
+        print(f'{label:<16} {size / num_commands:>8.1f} bytes/command')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Measure how subparse's hot paths scale with the number of commands.
+
+Synthetic applications with 10, 100 and 1000 commands are generated in a
+temporary directory as decorated command modules, registered with a fake
+installed distribution exposing them via entry points. For each size the
+script measures:
+
+- ``load_commands`` from the decorated modules and from a dict
+- ``load_commands_from_entry_point``
+- building the parser and ``parse_args``
+- rendering the top-level help
+- an end-to-end ``run`` in-process and in a fresh interpreter
+
+Both the best wall time and the peak memory allocated (via ``tracemalloc``)
+are reported. Results can be saved as JSON and compared against a previous
+run to catch regressions::
+
+    python benchmarks/bench_scaling.py --save baseline.json
+    python benchmarks/bench_scaling.py --compare baseline.json
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+
+SIZES = (10, 100, 1000)
+COMMANDS_PER_MODULE = 10
+GROUP = 'subparse_bench.commands'
+
+
+def generate_package(root, size):
+    """Write a package with ``size`` commands and a distribution for it."""
+    package = f'bench_cli_{size}'
+    pkgdir = os.path.join(root, package)
+    os.makedirs(pkgdir)
+    with open(os.path.join(pkgdir, '__init__.py'), 'w') as fp:
+        fp.write('')
+    with open(os.path.join(pkgdir, 'main.py'), 'w') as fp:
+        fp.write('def main(context, args):\n    return 0\n')
+
+    modules = []
+    for start in range(0, size, COMMANDS_PER_MODULE):
+        module = f'commands_{start}'
+        modules.append(f'{package}.{module}')
+        with open(os.path.join(pkgdir, module + '.py'), 'w') as fp:
+            fp.write('from subparse import command\n')
+            for i in range(start, min(start + COMMANDS_PER_MODULE, size)):
+                fp.write(
+                    textwrap.dedent(
+                        f'''
+
+                        @command('{package}.main')
+                        def cmd_{i}(parser):
+                            """
+                            Run synthetic command {i}.
+
+                            A longer description of the command which is
+                            wrapped over several lines.
+                            """
+                            parser.add_argument('--flag', action='store_true')
+                            parser.add_argument('--value', default='x')
+                            parser.add_argument('items', nargs='*')
+                        '''
+                    )
+                )
+
+    distinfo = os.path.join(root, f'{package}-1.0.dist-info')
+    os.makedirs(distinfo)
+    with open(os.path.join(distinfo, 'METADATA'), 'w') as fp:
+        fp.write(f'Metadata-Version: 2.1\nName: {package}\nVersion: 1.0\n')
+    with open(os.path.join(distinfo, 'entry_points.txt'), 'w') as fp:
+        fp.write(f'[{GROUP}_{size}]\n')
+        for module in modules:
+            fp.write(f'{module.rsplit(".", 1)[1]} = {module}\n')
+    return package, modules
+
+
+def measure(fn, setup=None, repeat=5, trace=True):
+    """
+    Return the best time and peak traced memory of calling ``fn``.
+
+    If ``setup`` is specified, it is called before each measurement and its
+    result is passed to ``fn``.
+
+    """
+    if setup is None:
+        setup = lambda: None
+        call = lambda state: fn()
+    else:
+        call = fn
+
+    best = float('inf')
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        call(state)
+        best = min(best, time.perf_counter() - start)
+
+    if not trace:
+        return best, None
+    state = setup()
+    tracemalloc.start()
+    try:
+        call(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def bench_size(root, size):
+    from subparse import CLI
+
+    package, modules = generate_package(root, size)
+    for module in modules:
+        __import__(module)
+    namespace = {}
+    for module in modules:
+        namespace.update(vars(sys.modules[module]))
+    group = f'{GROUP}_{size}'
+    argv = ['cmd-0', '--flag', '--value', 'y', 'a', 'b']
+
+    def new_cli(lazy=False):
+        return CLI(context_factory=lambda cli, args: None, lazy=lazy)
+
+    def loaded_cli(lazy=False):
+        cli = new_cli(lazy)
+        cli.load_commands_from_entry_point(group)
+        return cli
+
+    def load_modules(cli):
+        for module in modules:
+            cli.load_commands(module)
+
+    def render_help(cli):
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                cli.run(['--help'])
+            except SystemExit:
+                pass
+
+    results = {
+        'load_commands(module)': measure(load_modules, new_cli),
+        'load_commands(dict)': measure(
+            lambda cli: cli.load_commands(namespace), new_cli
+        ),
+        'load_commands_from_entry_point': measure(
+            lambda cli: cli.load_commands_from_entry_point(group), new_cli
+        ),
+        'compile': measure(lambda cli: cli.compile(), loaded_cli),
+        'compile(lazy)': measure(lambda cli: cli.compile(), lambda: loaded_cli(True)),
+        'parse_args': measure(
+            lambda parser: parser.parse_args(argv), lambda: loaded_cli().compile()
+        ),
+        'help': measure(render_help, loaded_cli),
+        'run': measure(lambda cli: cli.run(argv), loaded_cli),
+        'run(lazy)': measure(lambda cli: cli.run(argv), lambda: loaded_cli(True)),
+    }
+
+    script = (
+        'from subparse import CLI\n'
+        'cli = CLI(lazy=True)\n'
+        f'cli.load_commands_from_entry_point({group!r})\n'
+        f'cli.run({argv!r})\n'
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+    results['run(cold process)'] = measure(
+        lambda: subprocess.run([sys.executable, '-c', script], env=env, check=True),
+        repeat=3,
+        trace=False,
+    )
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, timings in results.items():
+        for name, (seconds, _) in timings.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous and seconds > previous[0] * threshold:
+                regressions.append((size, name, previous[0], seconds))
+    return regressions
+
+
+def report(results):
+    print(f'{"commands":>8}  {"benchmark":<32} {"time (ms)":>10} {"peak (KiB)":>11}')
+    for size, timings in results.items():
+        for name, (seconds, peak) in timings.items():
+            peak = '' if peak is None else f'{peak / 1024:.1f}'
+            print(f'{size:>8}  {name:<32} {seconds * 1e3:>10.3f} {peak:>11}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--save', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='compare with a previously saved run')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.25,
+        help='slowdown factor reported as a regression (default: 1.25)',
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        sys.path.insert(0, root)
+        try:
+            for size in args.sizes:
+                results[str(size)] = bench_size(root, size)
+        finally:
+            sys.path.remove(root)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        for size, name, before, after in regressions:
+            print(
+                f'REGRESSION {name} with {size} commands: '
+                f'{before * 1e3:.3f}ms -> {after * 1e3:.3f}ms',
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
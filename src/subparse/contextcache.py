@@ -0,0 +1,165 @@
+"""
+A persistent cache for the expensive parts of a context.
+
+Wrap a context factory, or a function called by one, to reuse its result
+across invocations until it expires::
+
+    from subparse.contextcache import ContextCache
+
+    cache = ContextCache('~/.cache/myapp/context.json', ttl=300, options=['env'])
+
+    @cache
+    def discover(cli, args, **context_kwargs):
+        return {'endpoint': lookup_endpoint(args.env), 'token': login()}
+
+    def context_factory(cli, args, **context_kwargs):
+        with make_client(**discover(cli, args, **context_kwargs)) as client:
+            yield client
+
+Results are stored as JSON, keyed by the ``context_kwargs`` and the values
+of the generic options named in ``options``.
+
+"""
+import functools
+import hashlib
+import json
+import os
+import time
+
+from .manifest import REFRESH_ENV
+
+CONTEXT_CACHE_VERSION = 1
+
+
+class ContextCache:
+    """
+    Cache the results of a context factory in the JSON file at ``path``.
+
+    Entries expire ``ttl`` seconds after they were stored. ``options`` is a
+    list of argument names (``dest``) whose values are part of the key.
+    Setting the ``SUBPARSE_REFRESH_CACHE`` environment variable ignores any
+    stored results, which are then replaced. The file is only readable by
+    its owner as the results may hold credentials.
+
+    """
+
+    def __init__(self, path, ttl=300, options=(), clock=time.time):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.options = list(options)
+        self.clock = clock
+
+    def __call__(self, factory):
+        """
+        Wrap ``factory``, which must return a JSON-serializable value.
+
+        Coroutine functions are supported. Generator functions are not, as
+        their cleanup would be skipped, so only the expensive part of such a
+        factory should be cached.
+
+        """
+        import inspect
+
+        if inspect.isgeneratorfunction(factory) or inspect.isasyncgenfunction(factory):
+            raise TypeError('generator context factories cannot be cached')
+        name = f'{factory.__module__}:{factory.__qualname__}'
+
+        if inspect.iscoroutinefunction(factory):
+
+            @functools.wraps(factory)
+            async def wrapper(cli, args, **context_kwargs):
+                key = self.key(name, args, context_kwargs)
+                found, value = self.get(key)
+                if not found:
+                    value = await factory(cli, args, **context_kwargs)
+                    self.set(key, value)
+                return value
+
+        else:
+
+            @functools.wraps(factory)
+            def wrapper(cli, args, **context_kwargs):
+                key = self.key(name, args, context_kwargs)
+                found, value = self.get(key)
+                if not found:
+                    value = factory(cli, args, **context_kwargs)
+                    self.set(key, value)
+                return value
+
+        return wrapper
+
+    def key(self, name, args, context_kwargs):
+        data = [
+            name,
+            sorted(context_kwargs.items()),
+            [[dest, getattr(args, dest, None)] for dest in self.options],
+        ]
+        encoded = json.dumps(data, sort_keys=True, default=repr).encode('utf8')
+        return hashlib.sha1(encoded).hexdigest()
+
+    def get(self, key):
+        """Return ``(found, value)`` for the entry stored under ``key``."""
+        if os.environ.get(REFRESH_ENV):
+            return False, None
+        entry = self._read().get(key)
+        if entry is None or entry['expires'] <= self.clock():
+            return False, None
+        return True, entry['value']
+
+    def set(self, key, value):
+        # fail before replacing the file if the value cannot be stored
+        json.dumps(value)
+        now = self.clock()
+        entries = {
+            k: entry for k, entry in self._read().items() if entry['expires'] > now
+        }
+        entries[key] = {'expires': now + self.ttl, 'value': value}
+        write_private_json(
+            self.path, {'version': CONTEXT_CACHE_VERSION, 'entries': entries}
+        )
+
+    def invalidate(self):
+        """Discard every stored result."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != CONTEXT_CACHE_VERSION:
+            return {}
+        return data.get('entries', {})
+
+
+def write_private_json(path, data):
+    """
+    Atomically write ``data`` to ``path``, readable by its owner only.
+
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        try:
+            fd = os.open(tmp, flags, 0o600)
+        except FileExistsError:
+            # left behind by an earlier process which had the same pid
+            os.unlink(tmp)
+            fd = os.open(tmp, flags, 0o600)
+        with open(fd, 'w', encoding='utf8') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:  # pragma: no cover
+            pass
+        return False
+    return True
@@ -0,0 +1,1618 @@
+import argparse
+from contextlib import ExitStack, contextmanager, nullcontext
+import os
+import sys
+
+from . import command
+
+
+class CommandMeta:
+    """
+    The metadata of a registered command.
+
+    Records use ``__slots__`` and interned names to stay small when an
+    application registers thousands of commands. Unless specified, the
+    ``help`` and ``description`` are parsed from the factory's docstring
+    the first time they are accessed.
+
+    """
+
+    __slots__ = ('factory', 'main', 'name', '_help', '_description', '_kwargs')
+    _fields = ('factory', 'main', 'name', 'help', 'description', 'context_kwargs')
+
+    def __init__(
+        self, factory, main, name, help=None, description=None, context_kwargs=None
+    ):
+        self.factory = factory
+        self.main = main
+        self.name = sys.intern(name)
+        self._help = help
+        self._description = description
+        self._kwargs = context_kwargs or None
+
+    @property
+    def help(self):
+        if self._help is None:
+            self._parse_docstring()
+        return self._help
+
+    @property
+    def description(self):
+        if self._description is None:
+            self._parse_docstring()
+        return self._description
+
+    @property
+    def context_kwargs(self):
+        return {} if self._kwargs is None else self._kwargs
+
+    def _parse_docstring(self):
+        doc = None if isinstance(self.factory, str) else self.factory.__doc__
+        short_desc, long_desc = parse_docstring(doc)
+        if long_desc:
+            long_desc = short_desc + '\n\n' + long_desc
+        if self._help is None:
+            self._help = short_desc
+        if self._description is None:
+            self._description = long_desc
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self._fields}
+
+    def _replace(self, **kwargs):
+        return type(self)(**dict(self._asdict(), **kwargs))
+
+    def __eq__(self, other):
+        if not isinstance(other, CommandMeta):
+            return NotImplemented
+        return self._asdict() == other._asdict()
+
+    def __repr__(self):
+        fields = ', '.join(f'{k}={v!r}' for k, v in self._asdict().items())
+        return f'CommandMeta({fields})'
+
+
+class CommandGroup:
+    """
+    A named group of nested commands, e.g. ``myapp db migrate``.
+
+    The commands are registered on a separate :class:`CLI` by the
+    ``loaders``, which are only called once the group is selected.
+
+    """
+
+    __slots__ = ('name', 'cli', 'help', 'description', '_loaders')
+
+    def __init__(self, name, cli, help='', description='', loaders=()):
+        self.name = sys.intern(name)
+        self.cli = cli
+        self.help = help
+        self.description = description
+        self._loaders = list(loaders)
+
+    def load(self):
+        """Call any pending loaders, registering the group's commands."""
+        loaders, self._loaders = self._loaders, []
+        # loading is part of parsing, so it should not discard the parent's
+        # compiled parser
+        parent, self.cli._parent = self.cli._parent, None
+        try:
+            for loader in loaders:
+                loader(self.cli)
+        finally:
+            self.cli._parent = parent
+        return self.cli
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        """Raise errors instead of printing and raising SystemExit."""
+        raise argparse.ArgumentError(None, message)
+
+
+class CLI:
+    _ArgumentParser = ArgumentParser
+    _namespace_key = '_subparse_meta'
+
+    def __init__(
+        self,
+        prog=None,
+        usage=None,
+        description=None,
+        version=None,
+        add_help_command=True,
+        context_factory=None,
+        lazy=False,
+        add_batch_command=False,
+        profile=None,
+        help_cache_file=None,
+        overlap_main_import=False,
+        telemetry=None,
+        add_fan_out_options=False,
+        add_pipelines=False,
+        parser_class=None,
+        add_shell_command=False,
+    ):
+        self.prog = prog
+        self.usage = usage
+        self.description = description
+        self.version = version
+        self.add_help_command = add_help_command
+        self.add_batch_command = add_batch_command
+        self.add_pipelines = add_pipelines
+        self.add_shell_command = add_shell_command
+        if parser_class is not None:
+            self._ArgumentParser = parser_class
+        self.generic_options = []
+        self.commands = {}
+        self.groups = {}
+        self.context_factory = context_factory
+        self.lazy = lazy
+        self.help_cache_file = help_cache_file
+        self.overlap_main_import = overlap_main_import
+        self._parser = None
+        self._help_cache = {}
+        self._disk_help_cache = None
+        self._mains = {}
+        self._parent = None
+        self._entry_points = []
+        self._pending_entry_points = {}
+        self._partial_parser = None
+
+        if isinstance(telemetry, (list, tuple)):
+            from .telemetry import Telemetry
+
+            telemetry = Telemetry(telemetry)
+        self.telemetry = telemetry
+
+        if profile is None:
+            profile = os.environ.get('SUBPARSE_PROFILE')
+        self.profiler = None
+        self._report_profile = bool(profile)
+        if profile or telemetry is not None:
+            from .profile import Profiler
+
+            options = profile.split(',') if isinstance(profile, str) else ()
+            self.profiler = Profiler(
+                format='json' if 'json' in options else 'table',
+                memory='memory' in options,
+                # the telemetry only needs the phase timings
+                imports=bool(profile),
+            )
+
+        if version is not None:
+            self.add_generic_option(
+                '-V', '--version', action='version', version=version
+            )
+        if add_fan_out_options:
+            self.add_generic_options(fan_out_options)
+
+    def add_generic_options(self, generic_options):
+        """
+        Register a function containing generic options.
+
+        The function should accept an instance of an
+        :class:`argparse.ArgumentParser` and use it to define extra
+        arguments and options.
+
+        """
+        self.generic_options.append(generic_options)
+        self.invalidate()
+
+    def add_generic_option(self, *args, **kwargs):
+        def generic_options(parser):
+            parser.add_argument(*args, **kwargs)
+
+        self.add_generic_options(generic_options)
+
+    def add_command(self, factory, main, name=None, context_kwargs=None):
+        """
+        Attach a command directly to the :class:`CLI` object.
+
+        """
+        if name is None:
+            name = factory.__name__.replace('_', '-')
+
+        # determine the absolute import string if relative
+        if isinstance(main, str) and (main.startswith('.') or main.startswith(':')):
+            module = sys.modules.get(factory.__module__)
+            if module is None:  # pragma: no cover
+                module = __import__(factory.__module__, None, None, ['__doc__'])
+            package = package_for_module(module)
+            if main in ['.', ':']:
+                main = package.__name__
+            else:
+                main = package.__name__ + main
+
+        self.invalidate()
+        meta = self.commands[name] = CommandMeta(
+            factory=factory,
+            main=main,
+            name=name,
+            context_kwargs=context_kwargs,
+        )
+        return meta
+
+    def add_group(
+        self,
+        name,
+        commands=None,
+        entry_point=None,
+        loader=None,
+        help='',
+        description='',
+    ):
+        """
+        Attach a nested group of commands, e.g. ``myapp db migrate``.
+
+        The commands of the group are loaded from ``commands`` (anything
+        accepted by :meth:`load_commands`), from the ``entry_point`` group
+        and by calling ``loader`` with the group's :class:`CLI`. None of
+        these are imported or called until the group is selected on the
+        command line.
+
+        Returns the group's :class:`CLI`, which may be used to attach
+        commands, generic options and further groups directly. The generic
+        options of a group are given after its name, e.g.
+        ``myapp db --dsn URL migrate``.
+
+        """
+        if isinstance(commands, str):
+            commands = commands.replace(':', '.')
+            if commands.startswith('.'):
+                from importlib.util import resolve_name
+
+                commands = resolve_name(commands, caller_package().__name__)
+
+        loaders = []
+        if commands is not None:
+            loaders.append(lambda cli: cli.load_commands(commands))
+        if entry_point is not None:
+            loaders.append(lambda cli: cli.load_commands_from_entry_point(entry_point))
+        if loader is not None:
+            loaders.append(loader)
+
+        group_cli = type(self)(
+            prog=f'{self.prog} {name}' if self.prog else None,
+            add_help_command=False,
+            lazy=self.lazy,
+            profile=False,
+        )
+        group_cli._parent = self
+        self.invalidate()
+        self.groups[name] = CommandGroup(
+            name, group_cli, help=help, description=description, loaders=loaders
+        )
+        return group_cli
+
+    def command(self, *args, **kwargs):
+        """
+        Attach a command to the current :class:`CLI` object.
+
+        The function should accept an instance of an
+        :class:`argparse.ArgumentParser` and use it to define extra
+        arguments and options. These options will only affect the specified
+        command.
+
+        """
+
+        def wrapper(func):
+            self.add_command(func, *args, **kwargs)
+            return func
+
+        return wrapper
+
+    def load_commands(self, obj):
+        """
+        Load commands defined on an arbitrary object.
+
+        All functions decorated with the :func:`subparse.command` decorator
+        attached the specified object will be loaded. The object may
+        be a dictionary, an arbitrary python object, or a dotted path.
+
+        The dotted path may be absolute, or relative to the current package
+        by specifying a leading '.' (e.g. ``'.commands'``).
+
+        """
+        if isinstance(obj, str):
+            obj = obj.replace(':', '.')
+            package = caller_package().__name__ if obj.startswith('.') else None
+        with self._profile('load_commands'):
+            if isinstance(obj, str):
+                from importlib import import_module
+
+                obj = import_module(obj, package)
+            command.discover_and_call(obj, self.command)
+
+    def load_commands_from_entry_point(
+        self,
+        specifier,
+        cache_file=None,
+        max_workers=None,
+        on_demand=False,
+        refresh=False,
+    ):
+        """
+        Load commands defined within a distribution entry point.
+
+        Each entry will be a module that should be searched for functions
+        decorated with the :func:`subparse.command` decorator. This
+        operation is not recursive.
+
+        If ``cache_file`` is specified, the discovered commands are saved to
+        a manifest at that path. Subsequent calls will load the commands
+        from the manifest without scanning the installed distributions or
+        importing any of the command modules. The manifest is rebuilt
+        automatically when the installed packages or the command modules
+        change, or when the ``SUBPARSE_REFRESH_CACHE`` environment variable
+        is set. Pass ``refresh=True`` to ignore the manifest and rebuild it
+        explicitly, for example from a command which installs plugins.
+
+        If ``max_workers`` is greater than one, the entry point modules are
+        imported concurrently using a pool of threads. Commands are still
+        registered in the order of the entry points. An ``ImportError``
+        naming the entry point is raised if any of the modules fail to load.
+
+        If ``on_demand`` is true, nothing is loaded until the commands are
+        needed. When running a command, only the entry points named after
+        the command, or a prefix of it, are loaded. All of the entry points
+        are loaded when the help is rendered, the parser is compiled or the
+        command is not found this way. If ``cache_file`` is also specified,
+        the manifest is used instead, as it is cheaper than importing any
+        of the entry points.
+
+        """
+        if on_demand:
+            self._entry_points.append((specifier, cache_file, max_workers, refresh))
+            self.invalidate()
+            return
+        with self._profile('load_commands_from_entry_point'):
+            self._load_commands_from_entry_point(
+                specifier, cache_file, max_workers, refresh
+            )
+
+    def _load_entry_points(self, name=None):
+        """
+        Load the entry points deferred by ``on_demand``.
+
+        If ``name`` is a command name, only the entry points matching it are
+        loaded as long as they define the command.
+
+        """
+        if not self._entry_points:
+            return
+        if name is not None and name in self.commands:
+            return
+        with self._profile('load_commands_from_entry_point'):
+            if name is not None and not name.startswith('-'):
+                for source in list(self._entry_points):
+                    specifier, cache_file, max_workers, _ = source
+                    if cache_file is not None:
+                        self._entry_points.remove(source)
+                        self._load_commands_from_entry_point(*source)
+                        continue
+                    remaining = self._pending_entry_points.get(specifier)
+                    if remaining is None:
+                        remaining = list(select_entry_points(specifier))
+                    entries = [ep for ep in remaining if name.startswith(ep.name)]
+                    self._pending_entry_points[specifier] = [
+                        ep for ep in remaining if ep not in entries
+                    ]
+                    self._register_entry_points(entries, max_workers)
+                if name in self.commands:
+                    return
+            pending, self._entry_points = self._entry_points, []
+            for source in pending:
+                specifier, _, max_workers, _ = source
+                remaining = self._pending_entry_points.pop(specifier, None)
+                if remaining is None:
+                    self._load_commands_from_entry_point(*source)
+                else:
+                    self._register_entry_points(remaining, max_workers)
+
+    def _load_commands_from_entry_point(
+        self, specifier, cache_file, max_workers, refresh=False
+    ):
+        if cache_file is not None:
+            from . import manifest
+
+            records = None
+            if not refresh:
+                records = manifest.read_manifest(cache_file, specifier)
+            if records is not None:
+                for record in records:
+                    meta = CommandMeta(**record)
+                    self.commands[meta.name] = meta
+                self.invalidate()
+                return
+
+        entries = select_entry_points(specifier)
+        metas, modules = self._register_entry_points(entries, max_workers)
+        if cache_file is not None:
+            manifest.write_manifest(cache_file, specifier, metas.values(), modules)
+
+    def _register_entry_points(self, entries, max_workers):
+        metas = {}
+        modules = []
+
+        def register(*args, **kwargs):
+            def wrapper(func):
+                meta = self.add_command(func, *args, **kwargs)
+                metas[meta.name] = meta
+                modules.append(sys.modules.get(func.__module__))
+                return func
+
+            return wrapper
+
+        for module in load_entry_points(entries, max_workers):
+            modules.append(module)
+            command.discover_and_call(module, register)
+        return metas, modules
+
+    def compile(self):
+        """
+        Build the :class:`argparse.ArgumentParser` for the application.
+
+        The parser is cached and reused by subsequent calls to :meth:`run`.
+        It is rebuilt automatically after a command or generic options are
+        added via :meth:`add_command` or :meth:`add_generic_options`. Any
+        direct modifications to :attr:`commands` or :attr:`generic_options`
+        require calling :meth:`invalidate`.
+
+        """
+        self._load_entry_points()
+        if self._parser is None:
+            with self._profile('build_parser'):
+                self._parser = build_parser(self)
+        return self._parser
+
+    def invalidate(self):
+        """Discard the parser cached by :meth:`compile` and any help text."""
+        self._parser = None
+        self._partial_parser = None
+        self._help_cache.clear()
+        self._disk_help_cache = None
+        if self._parent is not None:
+            self._parent.invalidate()
+
+    def format_help(self, name=None):
+        """
+        Return the help text of the application, or of the command ``name``.
+
+        The rendered text is cached in memory and, if ``help_cache_file``
+        was specified, on disk for use by later runs. Rendering the help of
+        the application never calls any factories and rendering the help
+        of a command only calls its own factory. Cached text is discarded
+        when the terminal width, the commands or the installed packages
+        change.
+
+        """
+        import shutil
+
+        self._load_entry_points()
+        key = f'{shutil.get_terminal_size().columns}:{name or ""}'
+        text = self._help_cache.get(key)
+        if text is not None:
+            return text
+
+        if self.help_cache_file is not None:
+            from . import manifest
+
+            if self._disk_help_cache is None:
+                self._disk_help_cache = manifest.read_help_cache(
+                    self.help_cache_file, self
+                )
+            text = self._disk_help_cache.get(key)
+
+        if text is None:
+            with self._profile('format_help'):
+                text = render_help(self, name)
+            if self.help_cache_file is not None:
+                self._disk_help_cache[key] = text
+                manifest.write_help_cache(
+                    self.help_cache_file, self, self._disk_help_cache
+                )
+
+        self._help_cache[key] = text
+        return text
+
+    def resolve_main(self, meta):
+        """
+        Return the main function of a command, importing it if necessary.
+
+        Resolved functions are cached on the :class:`CLI` so that repeated
+        runs do not need to look them up again.
+
+        """
+        if not isinstance(meta.main, str):
+            return meta.main
+        main = self._mains.get(meta.main)
+        if main is None:
+            main = self._mains[meta.main] = load_main(meta)
+        return main
+
+    def warmup(self, names=None, background=False):
+        """
+        Import the main functions of commands ahead of time.
+
+        ``names`` is a list of command names and defaults to every command.
+        If ``background`` is true, the imports are done on a daemon thread
+        which is returned, allowing them to overlap with other work such as
+        setting up the context. Any errors are ignored by the thread and
+        raised again when the command is run.
+
+        """
+        if names is None:
+            self._load_entry_points()
+            names = list(self.commands)
+        metas = [self.commands[name] for name in names]
+        if not background:
+            for meta in metas:
+                self.resolve_main(meta)
+            return None
+
+        import threading
+
+        def target():
+            for meta in metas:
+                try:
+                    self.resolve_main(meta)
+                except Exception:
+                    pass
+
+        thread = threading.Thread(target=target, name='subparse-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def _profile(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name)
+
+    def run(self, argv=None):
+        """
+        Run the command-line application.
+
+        This will dispatch to the specified function or raise a
+        ``SystemExit`` and output the appropriate usage information
+        if there is an error parsing the arguments.
+
+        The default ``argv`` is equivalent to ``sys.argv[1:]``.
+
+        """
+        if argv is None:  # pragma: no cover
+            argv = sys.argv[1:]
+        argv = [str(v) for v in argv]
+        if self.add_batch_command and argv and argv[0] == 'batch':
+            return run_batch(self, argv[1:])
+        if self.add_shell_command and argv and argv[0] == 'shell':
+            return run_shell(self, argv[1:])
+        if self.add_pipelines and '--' in argv:
+            return self.run_pipeline(split_pipeline(argv))
+        meta = None
+        result = error = None
+        try:
+            meta, args = parse_args(self, argv)
+            result = run_fan_out_option(self, meta, args)
+            if result is not None:
+                return result
+            with ExitStack() as stack:
+                loop = EventLoop()
+                stack.callback(loop.close)
+                pending_main = submit_load_main(self, stack, meta)
+                context = enter_context(
+                    self, stack, open_context(self, args, meta.context_kwargs, loop)
+                )
+                main = profiled_load_main(self, meta, pending_main)
+                with self._profile('main'):
+                    result = call_main(main, context, args, loop) or 0
+            return result
+        except SystemExit as ex:
+            result = exit_code(ex)
+            raise
+        except BaseException as ex:
+            result, error = 1, ex
+            raise
+        finally:
+            record_event(self, argv, meta, result, error)
+            self._report()
+
+    def run_pipeline(self, argvs):
+        """
+        Run several commands in one process, streaming records between them.
+
+        Each command's main function is passed the records produced by the
+        previous command as ``args.records``, which is ``None`` for the
+        first command. A main function produces records by returning an
+        iterable, typically by being a generator, so records are passed on
+        one at a time as the last command consumes them. Any records
+        returned by the last command are discarded.
+
+        All of the commands are parsed before any of them is run. The
+        context is entered once, with the arguments and ``context_kwargs``
+        of the first command, and shared by every command.
+
+        Returns the exit code of the last command. If another command
+        returns a non-zero exit code, the pipeline stops and that exit code
+        is returned.
+
+        """
+        argvs = [[str(v) for v in argv] for argv in argvs]
+        metas = []
+        result = error = None
+        try:
+            stages = [parse_args(self, argv) for argv in argvs]
+            metas = [meta for meta, args in stages]
+            with ExitStack() as stack:
+                loop = EventLoop()
+                stack.callback(loop.close)
+                meta, args = stages[0]
+                context = enter_context(
+                    self, stack, open_context(self, args, meta.context_kwargs, loop)
+                )
+                mains = [profiled_load_main(self, meta) for meta in metas]
+                with self._profile('main'):
+                    result = call_pipeline(mains, stages, context, loop)
+            return result
+        except SystemExit as ex:
+            result = exit_code(ex)
+            raise
+        except BaseException as ex:
+            result, error = 1, ex
+            raise
+        finally:
+            argv = [arg for argv in argvs for arg in argv + ['--']][:-1]
+            record_event(self, argv, metas[0] if metas else None, result, error)
+            self._report()
+
+    def run_parallel(self, argv, targets, jobs=None, ordered=True, dest='target'):
+        """
+        Run a command once for each of ``targets`` on a pool of processes.
+
+        ``argv`` is parsed once and each target is stored on the parsed
+        arguments as ``dest`` before calling the command's main function.
+        Each of the ``jobs`` worker processes (by default one per CPU)
+        enters the context once and reuses it for every target it runs.
+
+        The output of each target is captured and written once the target
+        has finished, in the order of ``targets`` if ``ordered`` is true or
+        as soon as each target finishes otherwise.
+
+        Returns a list containing the exit code of each target. Exceptions
+        raised by the main function are printed and reported as exit code 1.
+
+        """
+        from .parallel import run_parallel
+
+        meta, args = parse_args(self, [str(v) for v in argv])
+        return run_parallel(self, meta, args, targets, jobs, ordered, dest)
+
+    def _report(self):
+        if self.profiler is not None:
+            if self._report_profile:
+                self.profiler.report()
+            self.profiler.reset()
+
+    def run_many(self, argvs, stop_on_error=False, handle_errors=False):
+        """
+        Run several commands in the same process, sharing their context.
+
+        ``argvs`` may be any iterable of argument lists and is consumed
+        lazily. The ``context_factory`` is entered once for each distinct
+        set of ``context_kwargs``, the first time a command requiring it is
+        executed, and is passed the arguments of that command. All contexts
+        are exited after the last command has finished.
+
+        A command that fails to parse is reported with the exit code of the
+        ``SystemExit`` raised by the parser. If ``stop_on_error`` is true,
+        no further commands are run after the first non-zero exit code.
+
+        If ``handle_errors`` is true, an exception raised by a command is
+        printed to ``sys.stderr`` and reported as exit code 1, or 130 for a
+        ``KeyboardInterrupt``, instead of stopping all of the commands. A
+        ``SystemExit`` is reported with its exit code.
+
+        Commands given the ``--fan-out`` option run on worker processes and
+        pipelines share the context of their first command, as they do with
+        :meth:`run`.
+
+        Returns a list containing the exit code of each command.
+
+        Asynchronous contexts and commands all share a single event loop.
+
+        """
+        contexts = {}
+        results = []
+        try:
+            with ExitStack() as stack:
+                loop = EventLoop()
+                stack.callback(loop.close)
+                for argv in argvs:
+                    argv = [str(v) for v in argv]
+                    meta = None
+                    first_phase = len(self.profiler.phases) if self.profiler else 0
+                    try:
+                        if self.add_pipelines and '--' in argv:
+                            commands = split_pipeline(argv)
+                        else:
+                            commands = [argv]
+                        stages = [parse_args(self, stage) for stage in commands]
+                        meta, args = stages[0]
+                    except SystemExit as ex:
+                        result = exit_code(ex)
+                    else:
+                        try:
+                            result = None
+                            if len(stages) == 1:
+                                result = run_fan_out_option(self, meta, args)
+                            if result is None:
+                                result = self._run_shared(stack, contexts, stages, loop)
+                        except SystemExit as ex:
+                            if not handle_errors:
+                                raise
+                            result = exit_code(ex)
+                        except KeyboardInterrupt:
+                            if not handle_errors:
+                                raise
+                            print('KeyboardInterrupt', file=sys.stderr)
+                            result = 130
+                        except Exception:
+                            if not handle_errors:
+                                raise
+                            import traceback
+
+                            traceback.print_exc()
+                            result = 1
+                    record_event(self, argv, meta, result, first_phase=first_phase)
+                    results.append(result)
+                    if stop_on_error and result:
+                        break
+        finally:
+            self._report()
+        return results
+
+    def _run_shared(self, stack, contexts, stages, loop):
+        meta, args = stages[0]
+        key = repr(sorted(meta.context_kwargs.items()))
+        pending_main = None
+        if key not in contexts:
+            pending_main = submit_load_main(self, stack, meta)
+            contexts[key] = enter_context(
+                self, stack, open_context(self, args, meta.context_kwargs, loop)
+            )
+        mains = [profiled_load_main(self, meta, pending_main)]
+        mains += [profiled_load_main(self, stage[0]) for stage in stages[1:]]
+        with self._profile('main'):
+            if len(stages) > 1:
+                return call_pipeline(mains, stages, contexts[key], loop)
+            return call_main(mains[0], contexts[key], args, loop) or 0
+
+
+class EventLoop:
+    """
+    An event loop shared by a context and the commands using it.
+
+    The loop is only created once a coroutine needs to be run, so that
+    synchronous applications never import :mod:`asyncio`.
+
+    """
+
+    def __init__(self):
+        self.loop = None
+
+    def run(self, awaitable):
+        if self.loop is None:
+            import asyncio
+
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(awaitable)
+
+    @contextmanager
+    def context(self, cm):
+        """Enter an asynchronous context manager on the loop."""
+        context = self.run(cm.__aenter__())
+        try:
+            yield context
+        except BaseException:
+            if not self.run(cm.__aexit__(*sys.exc_info())):
+                raise
+        else:
+            self.run(cm.__aexit__(None, None, None))
+
+    def close(self):
+        loop, self.loop = self.loop, None
+        if loop is None:
+            return
+
+        import asyncio
+
+        try:
+            tasks = asyncio.all_tasks(loop)
+            if tasks:
+                for task in tasks:
+                    task.cancel()
+                gathered = asyncio.gather(*tasks, return_exceptions=True)
+                loop.run_until_complete(gathered)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+def open_context(cli, args, context_kwargs, loop):
+    """
+    Return a context manager for the context of a command.
+
+    The ``context_factory`` may be a plain function, a generator function,
+    a coroutine function or an asynchronous generator function. The
+    asynchronous variants are run on ``loop``.
+
+    """
+    import inspect
+
+    fn = cli.context_factory
+    if inspect.isasyncgenfunction(fn):
+        from contextlib import asynccontextmanager
+
+        return loop.context(asynccontextmanager(fn)(cli, args, **context_kwargs))
+    if inspect.iscoroutinefunction(fn):
+        return loop.context(awaited_context(fn(cli, args, **context_kwargs)))
+    return contextmanager(make_generator(fn))(cli, args, **context_kwargs)
+
+
+class awaited_context:
+    """An asynchronous context manager yielding the result of an awaitable."""
+
+    def __init__(self, awaitable):
+        self.awaitable = awaitable
+
+    async def __aenter__(self):
+        return await self.awaitable
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def call_main(main, context, args, loop):
+    import inspect
+
+    result = main(context, args)
+    if inspect.isawaitable(result):
+        result = loop.run(result)
+    return result
+
+
+def call_pipeline(mains, stages, context, loop):
+    records = None
+    for index, (main, (_meta, args)) in enumerate(zip(mains, stages)):
+        args.records = records
+        result = call_main(main, context, args, loop)
+        if index == len(stages) - 1:
+            break
+        if result is None:
+            result = ()
+        elif isinstance(result, int):
+            if result:
+                return result
+            result = ()
+        records = iter(result)
+    if result is not None and not isinstance(result, int):
+        for _ in result:
+            pass
+        return 0
+    return result or 0
+
+
+def split_pipeline(argv):
+    """Split ``argv`` into the command lines separated by ``--``."""
+    argvs = [[]]
+    for arg in argv:
+        if arg == '--':
+            argvs.append([])
+        else:
+            argvs[-1].append(arg)
+    return argvs
+
+
+def enter_context(cli, stack, cm):
+    if cli.profiler is None:
+        return stack.enter_context(cm)
+    return cli.profiler.enter_context(stack, cm)
+
+
+def submit_load_main(cli, stack, meta):
+    """
+    Start importing the main function of ``meta`` on a worker thread.
+
+    Returns a future, or ``None`` if ``cli.overlap_main_import`` is not
+    enabled. The worker is joined when ``stack`` is closed, so the import
+    never outlives the command even if entering the context fails, in which
+    case the context's error is raised and any import error is discarded.
+
+    """
+    if not cli.overlap_main_import:
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    stack.callback(executor.shutdown)
+    return executor.submit(cli.resolve_main, meta)
+
+
+def profiled_load_main(cli, meta, pending_main=None):
+    if cli.profiler is None:
+        return wait_for_main(cli, meta, pending_main)
+    with cli.profiler.phase('load_main'), cli.profiler.trace_imports():
+        return wait_for_main(cli, meta, pending_main)
+
+
+def wait_for_main(cli, meta, pending_main):
+    if pending_main is None:
+        return cli.resolve_main(meta)
+    return pending_main.result()
+
+
+def run_batch(cli, argv):
+    """
+    Execute the ``batch`` command.
+
+    Each line of the specified file (or stdin for ``-``) is split like a
+    shell command line and run via :meth:`CLI.run_many`. Blank lines and
+    ``#`` comments are ignored. Errors raised by a command are reported
+    without stopping the batch, and a line which cannot be split fails with
+    exit code 2. The exit code of each failing line is printed once the
+    batch has finished. Returns the first non-zero exit code.
+
+    """
+    parser = cli._ArgumentParser(
+        prog=f'{cli.prog or os.path.basename(sys.argv[0])} batch',
+        description='Run the commands listed in a file.',
+    )
+    parser.add_argument('file', help='a file of commands, or - for stdin')
+    parser.add_argument(
+        '--stop-on-error',
+        action='store_true',
+        help='stop after the first command that fails',
+    )
+    try:
+        args = parser.parse_args(argv)
+    except argparse.ArgumentError as e:
+        parser.print_help(file=sys.stderr)
+        parser.exit(2, f'{parser.prog}: error: {str(e)}\n')
+
+    if args.file == '-':
+        return run_batch_lines(cli, parser.prog, sys.stdin, args.stop_on_error)
+    with open(args.file, encoding='utf8') as fp:
+        return run_batch_lines(cli, parser.prog, fp, args.stop_on_error)
+
+
+def run_batch_lines(cli, prog, lines, stop_on_error=False):
+    commands = []
+    failures = []
+
+    def argvs():
+        for lineno, line, argv, error in read_batch(lines):
+            if error is not None:
+                print(f'{prog}: line {lineno}: {error}', file=sys.stderr)
+                failures.append((lineno, line, 2))
+                if stop_on_error:
+                    return
+                continue
+            commands.append((lineno, line))
+            yield argv
+
+    results = cli.run_many(argvs(), stop_on_error, handle_errors=True)
+    failures.extend(
+        (lineno, line, result)
+        for (lineno, line), result in zip(commands, results)
+        if result
+    )
+    failures.sort()
+    for lineno, line, result in failures:
+        print(f'{prog}: line {lineno}: exit code {result}: {line}', file=sys.stderr)
+    return failures[0][2] if failures else 0
+
+
+def fan_out_options(parser):
+    parser.add_argument(
+        '--fan-out',
+        metavar='FILE',
+        dest='_subparse_fan_out',
+        help='run the command for each target listed in FILE, or - for stdin',
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        dest='_subparse_jobs',
+        help='the number of processes used by --fan-out',
+    )
+
+
+def run_fan_out_option(cli, meta, args):
+    """
+    Run the command for every target listed by the ``--fan-out`` option.
+
+    Returns ``None`` if the option was not given.
+
+    """
+    path = getattr(args, '_subparse_fan_out', None)
+    if path is None:
+        return None
+
+    from .parallel import run_fan_out
+
+    with cli._profile('main'):
+        return run_fan_out(cli, meta, args, path, args._subparse_jobs)
+
+
+def run_shell(cli, argv):
+    """
+    Execute the ``shell`` command.
+
+    Each line read from stdin is split like a shell command line and run
+    via :meth:`CLI.run_many`, so the parser, the imported main functions
+    and the context are reused by every command. Errors are reported
+    without leaving the shell. ``exit``, ``quit`` or end of file leaves it.
+
+    """
+    prog = cli.prog or os.path.basename(sys.argv[0])
+    parser = cli._ArgumentParser(
+        prog=f'{prog} shell',
+        description='Run commands interactively.',
+    )
+    try:
+        parser.parse_args(argv)
+    except argparse.ArgumentError as e:
+        parser.print_help(file=sys.stderr)
+        parser.exit(2, f'{parser.prog}: error: {str(e)}\n')
+
+    cli.compile()
+    interactive = sys.stdin.isatty()
+    with shell_completion(cli, enabled=interactive):
+        cli.run_many(
+            read_shell(sys.stdin, f'{prog}> ' if interactive else None),
+            handle_errors=True,
+        )
+    return 0
+
+
+def read_shell(stdin, prompt=None):
+    import shlex
+
+    while True:
+        if prompt is None:
+            line = stdin.readline()
+            if not line:
+                return
+        else:
+            try:
+                line = input(prompt)
+            except KeyboardInterrupt:
+                print()
+                continue
+            except EOFError:
+                print()
+                return
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as ex:
+            print(f'error: {ex}', file=sys.stderr)
+            continue
+        if argv in (['exit'], ['quit']):
+            return
+        if argv:
+            yield argv
+
+
+@contextmanager
+def shell_completion(cli, enabled=True):
+    """Complete command names and options with ``readline``."""
+    try:
+        import readline
+    except ImportError:  # pragma: no cover
+        readline = None
+    if not enabled or readline is None:
+        yield
+        return
+
+    matches = []
+    parsers = {}
+
+    def complete(text, state):
+        if state == 0:
+            line = readline.get_line_buffer()[: readline.get_endidx()]
+            matches[:] = complete_shell_line(cli, line, text, parsers)
+        return matches[state] if state < len(matches) else None
+
+    previous = readline.get_completer(), readline.get_completer_delims()
+    readline.set_completer(complete)
+    readline.set_completer_delims(' \t\n')
+    readline.parse_and_bind('tab: complete')
+    try:
+        yield
+    finally:
+        readline.set_completer(previous[0])
+        readline.set_completer_delims(previous[1])
+
+
+def complete_shell_line(cli, line, text, parsers=None):
+    """
+    Return the completions of ``text`` at the end of ``line``.
+
+    The parsers built to complete the options of a command are cached in
+    ``parsers``.
+
+    """
+    if parsers is None:
+        parsers = {}
+    words = line.split()
+    if text and words:
+        words.pop()
+    if not words:
+        names = list(cli.commands) + list(cli.groups) + ['exit', 'help', 'quit']
+    elif words[0] in cli.commands:
+        name = words[0]
+        if name not in parsers:
+            commands = {name: cli.commands[name]}
+            parser = build_parser(cli, commands, lazy=False, groups={})
+            parsers[name] = parser._subparsers._group_actions[0].choices[name]
+        names = [
+            option
+            for action in parsers[name]._actions
+            for option in action.option_strings
+        ]
+    elif words == ['help']:
+        names = list(cli.commands) + list(cli.groups)
+    else:
+        names = []
+    return sorted(name for name in set(names) if name.startswith(text))
+
+
+def read_batch(lines):
+    """
+    Yield ``(lineno, line, argv, error)`` for each command in ``lines``.
+
+    ``error`` is the ``ValueError`` raised if the line cannot be split.
+
+    """
+    import shlex
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as ex:
+            yield lineno, line, None, ex
+            continue
+        if argv:
+            yield lineno, line, argv, None
+
+
+def record_event(cli, argv, meta, result, error=None, first_phase=0):
+    if cli.telemetry is None:
+        return
+    from .telemetry import make_event
+
+    phases = cli.profiler.phases[first_phase:]
+    cli.telemetry.record(make_event(argv, meta, phases, result, error))
+
+
+def exit_code(ex):
+    if ex.code is None:
+        return 0
+    if isinstance(ex.code, int):
+        return ex.code
+    return 1
+
+
+def select_entry_points(group):
+    import importlib.metadata
+
+    eps = importlib.metadata.entry_points()
+
+    # getitem is deprecated in 3.10, so test for select and fallback
+    # gracefully for 3.8/3.9
+    return eps.select(group=group) if hasattr(eps, 'select') else eps[group]
+
+
+def load_entry_points(entries, max_workers=None):
+    """
+    Load each entry point, returning the results in the same order.
+
+    If ``max_workers`` is greater than one the entry points are loaded
+    concurrently on a thread pool.
+
+    """
+    if max_workers is None or max_workers <= 1:
+        return [load_entry_point(ep) for ep in entries]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(load_entry_point, ep) for ep in entries]
+    return [future.result() for future in futures]
+
+
+def load_entry_point(ep):
+    try:
+        return ep.load()
+    except Exception as ex:
+        raise ImportError(
+            f'unable to load entry point "{ep.name} = {ep.value}" '
+            f'from group "{ep.group}": {ex}'
+        ) from ex
+
+
+def build_parser(cli, commands=None, lazy=None, groups=None, lazy_groups=True):
+    if commands is None:
+        commands = cli.commands
+    if groups is None:
+        groups = cli.groups
+    if lazy is None:
+        lazy = cli.lazy
+    parser = cli._ArgumentParser(
+        prog=cli.prog,
+        usage=cli.usage,
+        description=cli.description,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_generic_options(parser, cli.generic_options)
+    add_commands(
+        parser,
+        commands,
+        cli._namespace_key,
+        lazy=lazy,
+        profiler=cli.profiler,
+        groups=groups,
+        lazy_groups=lazy_groups,
+    )
+    return parser
+
+
+def parse_args(cli, argv):
+    if '_ARGCOMPLETE' in os.environ:
+        cli._load_entry_points()
+        with cli._profile('autocomplete'):
+            autocomplete(cli)
+    if cli.add_help_command:
+        if argv and argv[0] == 'help':
+            argv.pop(0)
+            argv.append('--help')
+
+    if not argv:
+        sys.stderr.write(cli.format_help())
+        sys.exit(2)
+    if argv[-1] in ('-h', '--help') and len(argv) <= 2:
+        name = argv[0] if len(argv) == 2 else None
+        if name is None or name in cli.commands:
+            sys.stdout.write(cli.format_help(name))
+            sys.exit(0)
+
+    if cli._entry_points:
+        # only the entry points defining the command are loaded, so the
+        # parser is built for those commands and cached separately
+        cli._load_entry_points(argv[0])
+    if cli._entry_points:
+        parser = cli._partial_parser
+        if parser is None:
+            with cli._profile('build_parser'):
+                parser = cli._partial_parser = build_parser(cli)
+    else:
+        parser = cli.compile()
+    try:
+        with cli._profile('parse_args'):
+            args = parser.parse_args(argv)
+        meta = getattr(args, cli._namespace_key, None)
+        if not meta:
+            parser.print_help(file=sys.stderr)
+            parser.exit(2)
+        return meta, args
+
+    except argparse.ArgumentError as e:
+        parser.print_help(file=sys.stderr)
+        parser.exit(2, f'{parser.prog}: error: {str(e)}\n')
+
+
+def render_help(cli, name=None):
+    if name is None:
+        parser = cli._parser
+        if parser is None:
+            parser = build_parser(cli, lazy=True)
+        return parser.format_help()
+
+    parser = build_parser(cli, {name: cli.commands[name]}, lazy=False, groups={})
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return action.choices[name].format_help()
+
+
+def load_main(meta):
+    main = meta.main
+    if isinstance(main, str):
+        mod = main
+        func = 'main'
+        if ':' in mod:
+            mod, func = mod.split(':')
+        mod = __import__(mod, None, None, ['__doc__'])
+        main = getattr(mod, func)
+    return main
+
+
+def load_factory(meta):
+    factory = meta.factory
+    if isinstance(factory, str):
+        mod, qualname = factory.split(':')
+        factory = __import__(mod, None, None, ['__doc__'])
+        for attr in qualname.split('.'):
+            factory = getattr(factory, attr)
+    return factory
+
+
+def make_generator(fn):
+    import inspect
+
+    if inspect.isgeneratorfunction(fn):
+        return fn
+
+    def wrapper(*a, **kw):
+        ctx = None
+        if fn is not None:
+            ctx = fn(*a, **kw)
+        yield ctx
+
+    return wrapper
+
+
+def trim(docstring):
+    """Trim function from PEP-257."""
+    if not docstring:  # pragma: no cover
+        return ''
+    # Convert tabs to spaces (following the normal Python rules)
+    # and split into a list of lines:
+    lines = docstring.expandtabs().splitlines()
+    # Determine minimum indentation (first line doesn't count):
+    indent = sys.maxsize
+    for line in lines[1:]:
+        stripped = line.lstrip()
+        if stripped:
+            indent = min(indent, len(line) - len(stripped))
+    # Remove indentation (first line is special):
+    trimmed = [lines[0].strip()]
+    if indent < sys.maxsize:
+        for line in lines[1:]:
+            trimmed.append(line[indent:].rstrip())
+    # Strip off trailing and leading blank lines:
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    while trimmed and not trimmed[0]:
+        trimmed.pop(0)
+    # Return a single string:
+    return '\n'.join(trimmed)
+
+
+def parse_docstring(docstring):
+    """
+    Parse a PEP-257 docstring.
+
+    SHORT -> blank line -> LONG
+
+    """
+    short_desc = long_desc = ''
+    if docstring:
+        docstring = trim(docstring)
+        lines = docstring.split('\n\n', 1)
+        short_desc = lines[0].strip().replace('\n', ' ')
+
+        if len(lines) > 1:
+            long_desc = lines[1].strip()
+    return short_desc, long_desc
+
+
+def autocomplete(cli, output_stream=None, exit_method=os._exit):
+    """
+    Answer a shell completion request from ``argcomplete``.
+
+    Completing the command name is answered directly from the registry
+    without building any parsers or importing ``argcomplete``. Otherwise,
+    if a command has already been entered, only that command's parser is
+    built before handing over to ``argcomplete``.
+
+    """
+    comp_line = os.environ.get('COMP_LINE', '')
+    comp_point = int(os.environ.get('COMP_POINT', len(comp_line)))
+    comp_line = comp_line[:comp_point]
+    words = comp_line.split()
+    if not comp_line or comp_line[-1].isspace():
+        words.append('')
+    words = words[max(int(os.environ['_ARGCOMPLETE']) - 1, 0) :]
+    args, prefix = words[1:-1], words[-1]
+
+    if not prefix.startswith('-') and (
+        not args or (cli.add_help_command and args == ['help'])
+    ):
+        choices = {name: meta.help for name, meta in cli.commands.items()}
+        choices.update((name, group.help) for name, group in cli.groups.items())
+        if cli.add_help_command and not args:
+            choices.setdefault('help', 'show help for a command')
+        completions = sorted(name for name in choices if name.startswith(prefix))
+        if os.environ.get('_ARGCOMPLETE_SHELL') == 'zsh':
+            completions = [
+                name.replace(':', '\\:') + ':' + choices[name] for name in completions
+            ]
+        if output_stream is None:  # pragma: no cover
+            output_stream = os.fdopen(8, 'w')
+        ifs = os.environ.get('_ARGCOMPLETE_IFS', '\013')
+        output_stream.write(ifs.join(completions))
+        output_stream.flush()
+        exit_method(0)
+        return
+
+    # argcomplete must see the fully built subparser of the selected command
+    for arg in args:
+        if arg in cli.commands:
+            parser = build_parser(cli, {arg: cli.commands[arg]}, lazy=False, groups={})
+            break
+        if arg in cli.groups:
+            parser = build_parser(
+                cli, {}, lazy=False, groups={arg: cli.groups[arg]}, lazy_groups=False
+            )
+            break
+    else:
+        parser = build_parser(cli)
+    try_argcomplete(parser)
+
+
+def try_argcomplete(parser):  # pragma: no cover
+    try:
+        import argcomplete
+    except ImportError:
+        pass
+    else:
+        argcomplete.autocomplete(parser)
+
+
+def add_generic_options(parser, fns):
+    for func in fns:
+        func(parser)
+
+
+class LazyChoicesPseudoAction(argparse._SubParsersAction._ChoicesPseudoAction):
+    """Lists a command in the help, reading its help text on demand."""
+
+    def __init__(self, item):
+        self.item = item
+        super().__init__(item.name, (), None)
+
+    help = property(lambda self: self.item.help, lambda self, value: None)
+
+
+class LazySubParsersAction(argparse._SubParsersAction):
+    """
+    A subparsers action that defers building command parsers.
+
+    Each command or group is registered with its name only. Its help text
+    is read when the help is rendered, and its parser is created the first
+    time it is selected on the command line.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = {}
+
+    def defer(self, meta, namespace_key, profiler=None):
+        self._add_placeholder(meta)
+        self._pending[meta.name] = (add_command_parser, meta, namespace_key, profiler)
+
+    def defer_group(self, group, namespace_key, profiler=None):
+        self._add_placeholder(group)
+        self._pending[group.name] = (add_group_parser, group, namespace_key, profiler)
+
+    def _add_placeholder(self, item):
+        # the item is a placeholder, keeping the name a valid choice
+        self._name_parser_map[item.name] = item
+        self._choices_actions.append(LazyChoicesPseudoAction(item))
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        pending = self._pending.pop(values[0], None)
+        if pending is not None:
+            add_parser, item, namespace_key, profiler = pending
+            del self._name_parser_map[item.name]
+            add_parser(self, item, namespace_key, profiler)
+        super().__call__(parser, namespace, values, option_string)
+
+
+def add_commands(
+    parser,
+    commands,
+    namespace_key,
+    lazy=False,
+    profiler=None,
+    groups=None,
+    lazy_groups=True,
+):
+    kw = {}
+    if lazy or (groups and lazy_groups):
+        kw['action'] = LazySubParsersAction
+    subparsers = parser.add_subparsers(title='commands', metavar='<command>', **kw)
+    for meta in sorted(commands.values(), key=lambda m: m.name):
+        if lazy:
+            subparsers.defer(meta, namespace_key, profiler)
+        else:
+            add_command_parser(subparsers, meta, namespace_key, profiler, help=True)
+    for group in sorted((groups or {}).values(), key=lambda g: g.name):
+        if lazy_groups:
+            subparsers.defer_group(group, namespace_key, profiler)
+        else:
+            add_group_parser(subparsers, group, namespace_key, profiler, help=True)
+
+
+def add_command_parser(subparsers, meta, namespace_key, profiler=None, help=False):
+    kw = {'help': meta.help} if help else {}
+    subparser = subparsers.add_parser(
+        meta.name,
+        description=meta.description,
+        formatter_class=argparse.RawTextHelpFormatter,
+        **kw,
+    )
+    call_factory(meta, subparser, profiler)
+    subparser.set_defaults(**{namespace_key: meta})
+
+
+def add_group_parser(subparsers, group, namespace_key, profiler=None, help=False):
+    kw = {'help': group.help} if help else {}
+    subparser = subparsers.add_parser(
+        group.name,
+        description=group.description or group.help,
+        formatter_class=argparse.RawTextHelpFormatter,
+        **kw,
+    )
+    if profiler is None:
+        group_cli = group.load()
+    else:
+        with profiler.factory(group.name):
+            group_cli = group.load()
+    add_generic_options(subparser, group_cli.generic_options)
+    add_commands(
+        subparser,
+        group_cli.commands,
+        namespace_key,
+        lazy=group_cli.lazy,
+        profiler=profiler,
+        groups=group_cli.groups,
+    )
+
+
+def call_factory(meta, parser, profiler=None):
+    if profiler is None:
+        load_factory(meta)(parser)
+        return
+    with profiler.factory(meta.name):
+        load_factory(meta)(parser)
+
+
+# stolen from pyramid.path
+def caller_module(level=2):
+    module_globals = sys._getframe(level).f_globals
+    module_name = module_globals.get('__name__') or '__main__'
+    module = sys.modules[module_name]
+    return module
+
+
+# stolen from pyramid.path
+def package_for_module(module):  # pragma: no cover
+    f = getattr(module, '__file__', '')
+    if ('__init__.py' in f) or ('__init__$py' in f):  # empty at >>>
+        # Module is a package
+        return module
+    # Go up one level to get package
+    package_name = module.__name__.rsplit('.', 1)[0]
+    return sys.modules[package_name]
+
+
+# stolen from pyramid.path
+def caller_package(level=2):
+    # caller_module in arglist for tests
+    module = caller_module(level + 1)
+    return package_for_module(module)
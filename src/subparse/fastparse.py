@@ -0,0 +1,210 @@
+"""
+A faster drop-in parser for commands using simple options.
+
+:class:`FastArgumentParser` compiles the options of each parser into a
+lookup table the first time it is used and parses the command line in a
+single pass. It understands flags (``store_true``, ``store_false``,
+``store_const``, ``count``), options taking one value (``store`` and
+``append``, written as ``--opt value`` or ``--opt=value``), positional
+arguments taking one value, and subcommands. Anything else, including
+help, abbreviated options, ``--`` and every error, is handed to
+:mod:`argparse` which produces the same result and messages as before::
+
+    from subparse.fastparse import FastArgumentParser
+
+    cli = CLI(parser_class=FastArgumentParser)
+
+"""
+import argparse
+import sys
+
+from .core import ArgumentParser
+
+PARSER = argparse.PARSER
+SUPPRESS = argparse.SUPPRESS
+UNRECOGNIZED_ARGS_ATTR = argparse._UNRECOGNIZED_ARGS_ATTR
+
+STORE = 'store'
+APPEND = 'append'
+CONST = 'const'
+COUNT = 'count'
+
+ACTION_KINDS = {
+    argparse._StoreAction: STORE,
+    argparse._AppendAction: APPEND,
+    argparse._StoreConstAction: CONST,
+    argparse._StoreTrueAction: CONST,
+    argparse._StoreFalseAction: CONST,
+    argparse._CountAction: COUNT,
+}
+
+
+class Unsupported(Exception):
+    """Raised when the command line must be parsed by :mod:`argparse`."""
+
+
+class FastArgumentParser(ArgumentParser):
+    """An :class:`ArgumentParser` parsing simple command lines in one pass."""
+
+    _fast_table = None
+    _fast_table_size = None
+
+    def parse_known_args(self, args=None, namespace=None):
+        if namespace is None:
+            try:
+                return self._fast_parse_known_args(
+                    sys.argv[1:] if args is None else list(args)
+                )
+            except Unsupported:
+                pass
+        return super().parse_known_args(args, namespace)
+
+    def _fast_parse_known_args(self, args):
+        table = self._compile_fast_table()
+        namespace = argparse.Namespace()
+        for action in table.actions:
+            # like argparse, the first action sharing a dest sets its default
+            if (
+                action.dest is not SUPPRESS
+                and not hasattr(namespace, action.dest)
+                and action.default is not SUPPRESS
+            ):
+                setattr(namespace, action.dest, action.default)
+        for dest, value in self._defaults.items():
+            if not hasattr(namespace, dest):
+                setattr(namespace, dest, value)
+
+        seen = set()
+        positionals = iter(table.positionals)
+        subcommand = None
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            index += 1
+            if arg[:1] == '-' and arg != '-':
+                name, sep, value = arg.partition('=')
+                if not arg.startswith('--'):
+                    name, sep = arg, ''
+                option = table.options.get(name)
+                if option is None:
+                    raise Unsupported
+                action, kind = option
+                if kind in (STORE, APPEND):
+                    if not sep:
+                        if index == len(args) or args[index][:1] == '-':
+                            raise Unsupported
+                        value = args[index]
+                        index += 1
+                    value = convert(self, action, value)
+                    if kind == APPEND:
+                        items = getattr(namespace, action.dest, None) or []
+                        value = list(items) + [value]
+                elif sep:
+                    raise Unsupported
+                elif kind == CONST:
+                    value = action.const
+                else:
+                    value = (getattr(namespace, action.dest, None) or 0) + 1
+                setattr(namespace, action.dest, value)
+                seen.add(action)
+            else:
+                action = next(positionals, None)
+                if action is None:
+                    raise Unsupported
+                seen.add(action)
+                if action.nargs == PARSER:
+                    if arg not in action.choices:
+                        raise Unsupported
+                    subcommand = (action, args[index - 1 :])
+                    break
+                setattr(namespace, action.dest, convert(self, action, arg))
+
+        for action in table.actions:
+            if action in seen:
+                continue
+            if action.required:
+                raise Unsupported
+            default = action.default
+            if (
+                isinstance(default, str)
+                and action.dest is not SUPPRESS
+                and getattr(namespace, action.dest, None) is default
+            ):
+                setattr(namespace, action.dest, convert(self, action, default))
+
+        extras = []
+        if subcommand is not None:
+            action, values = subcommand
+            try:
+                action(self, namespace, values)
+            except argparse.ArgumentError as err:
+                if not getattr(self, 'exit_on_error', True):
+                    raise
+                self.error(str(err))
+            extras = list(vars(namespace).pop(UNRECOGNIZED_ARGS_ATTR, ()))
+        return namespace, extras
+
+    def _compile_fast_table(self):
+        if self._fast_table_size != len(self._actions):
+            self._fast_table = compile_table(self)
+            self._fast_table_size = len(self._actions)
+        if self._fast_table is None:
+            raise Unsupported
+        return self._fast_table
+
+
+class Table:
+    __slots__ = ('actions', 'options', 'positionals')
+
+    def __init__(self, actions, options, positionals):
+        self.actions = actions
+        self.options = options
+        self.positionals = positionals
+
+
+def compile_table(parser):
+    """
+    Return the lookup table of ``parser``.
+
+    Returns ``None`` if the parser uses features which are not supported.
+
+    """
+    if (
+        parser.fromfile_prefix_chars
+        or parser.prefix_chars != '-'
+        or parser._mutually_exclusive_groups
+    ):
+        return None
+    options = {}
+    positionals = []
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            positionals.append(action)
+            continue
+        if isinstance(action, (argparse._HelpAction, argparse._VersionAction)):
+            # not in the table, so they are handled by argparse
+            continue
+        kind = ACTION_KINDS.get(type(action))
+        if kind is None:
+            return None
+        if action.option_strings:
+            if kind in (STORE, APPEND) and action.nargs is not None:
+                return None
+            for option_string in action.option_strings:
+                options[option_string] = (action, kind)
+        elif kind == STORE and action.nargs is None:
+            positionals.append(action)
+        else:
+            return None
+    return Table(list(parser._actions), options, positionals)
+
+
+def convert(parser, action, value):
+    type_func = parser._registry_get('type', action.type, action.type)
+    try:
+        value = type_func(value)
+    except (TypeError, ValueError, argparse.ArgumentTypeError):
+        raise Unsupported
+    if action.choices is not None and value not in action.choices:
+        raise Unsupported
+    return value
@@ -35,13 +35,16 @@ order of registrations is preserved.
 
 (c) holger krekel, 2013, License: MIT
 """
-from types import FunctionType
+from itertools import count
+from types import FunctionType, MethodType, ModuleType
 
 
 class lazydecorator:
     def __init__(self):
         self.attrname = "_" + hex(id(self))
-        self.num = 0
+        # next() on a count is atomic, keeping registration order consistent
+        # when modules are imported concurrently
+        self._counter = count()
 
     def __call__(self, *args, **kwargs):
         def decorate(func):
@@ -49,8 +52,7 @@ class lazydecorator:
                 num, siglist = getattr(func, self.attrname)
             except AttributeError:
                 siglist = []
-                func.__dict__[self.attrname] = (self.num, siglist)
-                self.num += 1
+                func.__dict__[self.attrname] = (next(self._counter), siglist)
             siglist.append((args, kwargs))
             return func
 
@@ -58,37 +60,50 @@ class lazydecorator:
 
     def discover(self, obj):
         decitems = []
-        if isinstance(obj, dict):
-
-            def iter():
-                for name in obj:
-                    yield name, obj[name]
-
-        else:
-
-            def iter():
-                for name in dir(obj):
-                    yield name, getattr(obj, name)
-
-        for _, func in iter():
-            func_orig = func
-            if not isinstance(func, FunctionType):
-                try:
-                    func = func.__func__
-                except AttributeError:
-                    continue
-            try:
-                num, siglist = getattr(func, self.attrname)
-            except AttributeError:
-                continue
-            decitems.append((num, func_orig, siglist))
-        decitems.sort()
+        for num, func, siglist in self._iter_decorated(obj):
+            decitems.append((num, func, siglist))
+        decitems.sort(key=lambda item: item[0])
         result = []
         for _, func_orig, siglist in decitems:
             for args, kwargs in siglist:
                 result.append((func_orig, args, kwargs))
         return result
 
+    def _iter_decorated(self, obj):
+        # read the raw namespaces instead of dir() + getattr() so that
+        # properties, descriptors and module __getattr__ hooks are only
+        # triggered for attributes which are actually decorated
+        if isinstance(obj, dict):
+            namespaces = [obj]
+            bind = False
+        else:
+            namespaces = []
+            try:
+                namespaces.append(vars(obj))
+            except TypeError:
+                pass
+            if not isinstance(obj, ModuleType):
+                cls = obj if isinstance(obj, type) else type(obj)
+                namespaces.extend(vars(klass) for klass in cls.__mro__)
+            bind = not isinstance(obj, ModuleType)
+
+        seen = set()
+        for namespace in namespaces:
+            for name, value in list(namespace.items()):
+                if name in seen:
+                    continue
+                seen.add(name)
+                func = value
+                if isinstance(func, (classmethod, staticmethod, MethodType)):
+                    func = func.__func__
+                if not isinstance(func, FunctionType):
+                    continue
+                try:
+                    num, siglist = func.__dict__[self.attrname]
+                except KeyError:
+                    continue
+                yield num, getattr(obj, name) if bind else value, siglist
+
     def discover_and_call(self, obj, dec):
         for func, args, kwargs in self.discover(obj):
             newfunc = dec(*args, **kwargs)(func)
@@ -0,0 +1,244 @@
+"""
+An on-disk cache of the commands discovered from an entry point.
+
+The manifest records enough metadata about each command to build the
+top-level parser without scanning installed distributions or importing
+any command modules. It is invalidated automatically whenever the
+interpreter, ``sys.path`` or any of the modules the commands were
+discovered in change.
+
+"""
+import json
+import os
+import sys
+
+HELP_CACHE_VERSION = 1
+
+MANIFEST_VERSION = 1
+REFRESH_ENV = 'SUBPARSE_REFRESH_CACHE'
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def environment_key():
+    """
+    Return a fingerprint of the current interpreter and installed packages.
+
+    Installing, upgrading or removing a distribution modifies the
+    directory it lives in, so the modification time of every ``sys.path``
+    entry is a cheap proxy for the versions of the installed distributions.
+
+    """
+    return {
+        'python': sys.version,
+        'executable': sys.executable,
+        'path': [[p, _mtime(p) if p else None] for p in sys.path],
+    }
+
+
+def dotted_name(obj):
+    """
+    Return a ``module:qualname`` string that resolves back to ``obj``.
+
+    Returns ``None`` if ``obj`` cannot be found again by name, for example
+    a lambda or a function defined inside another function.
+
+    """
+    module = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', None)
+    if not module or not qualname or '<' in qualname:
+        return None
+    target = sys.modules.get(module)
+    for part in qualname.split('.'):
+        target = getattr(target, part, None)
+    if target is not obj:
+        return None
+    return f'{module}:{qualname}'
+
+
+def dump_command(meta):
+    """
+    Serialize a :class:`subparse.CommandMeta` to a JSON-compatible dict.
+
+    Returns ``None`` if the command cannot be represented in a manifest.
+
+    """
+    factory = meta.factory
+    if not isinstance(factory, str):
+        factory = dotted_name(factory)
+    main = meta.main
+    if not isinstance(main, str):
+        main = dotted_name(main)
+    if factory is None or main is None:
+        return None
+    try:
+        context_kwargs = json.loads(json.dumps(meta.context_kwargs))
+    except (TypeError, ValueError):
+        return None
+    if context_kwargs != meta.context_kwargs:
+        return None
+    return {
+        'factory': factory,
+        'main': main,
+        'name': meta.name,
+        'help': meta.help,
+        'description': meta.description,
+        'context_kwargs': context_kwargs,
+    }
+
+
+def read_manifest(path, specifier):
+    """
+    Load the cached commands for ``specifier`` from ``path``.
+
+    Returns a list of command dicts, or ``None`` if the manifest is
+    missing, unreadable or stale.
+
+    """
+    if os.environ.get(REFRESH_ENV):
+        return None
+    try:
+        with open(path, encoding='utf8') as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    if (
+        data.get('version') != MANIFEST_VERSION
+        or data.get('specifier') != specifier
+        or data.get('environment') != environment_key()
+    ):
+        return None
+    for fname, mtime in data.get('files', {}).items():
+        if _mtime(fname) != mtime:
+            return None
+    return data.get('commands')
+
+
+def write_manifest(path, specifier, commands, modules):
+    """
+    Write the manifest for ``specifier`` to ``path``.
+
+    ``commands`` is a sequence of :class:`subparse.CommandMeta` objects and
+    ``modules`` the modules they were discovered in. Returns ``False``
+    without writing anything if any command cannot be cached.
+
+    """
+    records = []
+    for meta in commands:
+        record = dump_command(meta)
+        if record is None:
+            return False
+        records.append(record)
+
+    files = {}
+    for module in modules:
+        fname = getattr(module, '__file__', None)
+        if fname:
+            files[fname] = _mtime(fname)
+
+    data = {
+        'version': MANIFEST_VERSION,
+        'specifier': specifier,
+        'environment': environment_key(),
+        'files': files,
+        'commands': records,
+    }
+    return _write_json(path, data)
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(tmp, 'w', encoding='utf8') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:  # pragma: no cover
+            pass
+        return False
+    return True
+
+
+def _qualified(obj):
+    if isinstance(obj, str):
+        return [obj]
+    module = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', repr(obj))
+    closure = getattr(obj, '__closure__', None) or ()
+    return [f'{module}:{qualname}'] + [repr(cell.cell_contents) for cell in closure]
+
+
+def _source_files(cli):
+    files = {}
+    objs = list(cli.generic_options)
+    objs.extend(m.factory for m in cli.commands.values() if callable(m.factory))
+    for obj in objs:
+        module = sys.modules.get(getattr(obj, '__module__', None))
+        fname = getattr(module, '__file__', None)
+        if fname and fname not in files:
+            files[fname] = _mtime(fname)
+    return files
+
+
+def help_cache_key(cli):
+    """Return a fingerprint of everything that affects the help of ``cli``."""
+    import hashlib
+
+    data = {
+        'version': HELP_CACHE_VERSION,
+        'environment': environment_key(),
+        'cli': [
+            cli.prog,
+            cli.usage,
+            cli.description,
+            cli.version,
+            cli.add_help_command,
+        ],
+        'generic_options': [_qualified(fn) for fn in cli.generic_options],
+        'commands': [
+            [meta.name, meta.help, meta.description, _qualified(meta.factory)]
+            for meta in sorted(cli.commands.values(), key=lambda m: m.name)
+        ],
+        'groups': [
+            [group.name, group.help, group.description]
+            for group in sorted(cli.groups.values(), key=lambda g: g.name)
+        ],
+        'files': _source_files(cli),
+    }
+    encoded = json.dumps(data, sort_keys=True, default=repr).encode('utf8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def read_help_cache(path, cli):
+    """
+    Load the rendered help text cached for ``cli`` from ``path``.
+
+    Returns an empty dict if the cache is missing, unreadable or stale.
+
+    """
+    try:
+        with open(path, encoding='utf8') as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('key') != help_cache_key(cli):
+        return {}
+    return data.get('help', {})
+
+
+def write_help_cache(path, cli, entries):
+    """Save the rendered help text for ``cli`` to ``path``."""
+    data = {'key': help_cache_key(cli), 'help': entries}
+    return _write_json(path, data)
@@ -0,0 +1,128 @@
+"""
+Run one command for many targets on a pool of worker processes.
+
+The command line is parsed once. Each worker enters the context once and
+then runs the command's main function for every target it is given, with
+the target stored on the parsed arguments. The output of each target is
+captured and written by the parent process, either in the order of the
+targets or as soon as each target finishes.
+
+"""
+from contextlib import ExitStack, redirect_stderr, redirect_stdout
+import copy
+import io
+import os
+import sys
+import traceback
+
+_worker = None
+
+
+def run_parallel(cli, meta, args, targets, jobs=None, ordered=True, dest='target'):
+    """
+    Run the command described by ``meta`` and ``args`` for each target.
+
+    Returns a list containing the exit code of each target.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    targets = list(targets)
+    if not targets:
+        return []
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(targets)))
+
+    # forking lets the workers inherit the CLI without pickling it
+    mp_context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    results = [None] * len(targets)
+    with ProcessPoolExecutor(
+        jobs,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(cli, meta, args, dest),
+    ) as executor:
+        futures = {
+            executor.submit(run_target, target): index
+            for index, target in enumerate(targets)
+        }
+        for future in futures if ordered else as_completed(futures):
+            code, out, err = future.result()
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            results[futures[future]] = code
+    return results
+
+
+def run_fan_out(cli, meta, args, path, jobs=None):
+    """
+    Execute a command invoked with ``--fan-out``.
+
+    Each line of the file (or stdin for ``-``) is a target. Blank lines
+    and ``#`` comments are ignored. Returns the first non-zero exit code.
+
+    """
+    if path == '-':
+        targets = list(read_targets(sys.stdin))
+    else:
+        with open(path, encoding='utf8') as fp:
+            targets = list(read_targets(fp))
+    results = run_parallel(cli, meta, args, targets, jobs)
+    return next((result for result in results if result), 0)
+
+
+def read_targets(lines):
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def init_worker(cli, meta, args, dest):
+    global _worker
+    from multiprocessing.util import Finalize
+
+    from .core import EventLoop, open_context
+
+    stack = ExitStack()
+    Finalize(None, stack.close, exitpriority=0)
+    try:
+        loop = EventLoop()
+        stack.callback(loop.close)
+        context = stack.enter_context(
+            open_context(cli, args, meta.context_kwargs, loop)
+        )
+        main = cli.resolve_main(meta)
+    except Exception:
+        # reported by every target run by this worker
+        _worker = traceback.format_exc()
+    else:
+        _worker = (main, context, args, loop, dest)
+
+
+def run_target(target):
+    from .core import call_main, exit_code
+
+    if isinstance(_worker, str):
+        return 1, '', _worker
+
+    main, context, args, loop, dest = _worker
+    stdout, stderr = io.StringIO(), io.StringIO()
+    args = copy.copy(args)
+    setattr(args, dest, target)
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            code = call_main(main, context, args, loop) or 0
+        except SystemExit as ex:
+            code = exit_code(ex)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return code, stdout.getvalue(), stderr.getvalue()
@@ -0,0 +1,213 @@
+"""
+Timing instrumentation for :class:`subparse.CLI`.
+
+Enable it with ``CLI(profile=True)`` or by setting the ``SUBPARSE_PROFILE``
+environment variable. A report is written to ``sys.stderr`` after each run,
+either as a table or, with ``profile='json'`` or ``SUBPARSE_PROFILE=json``,
+as a JSON document. Adding ``memory``, e.g. ``SUBPARSE_PROFILE=json,memory``,
+also records the memory allocated in each phase using :mod:`tracemalloc`.
+
+"""
+import builtins
+from contextlib import ExitStack, contextmanager
+import json
+import sys
+import time
+
+
+class Profiler:
+    """
+    Record the time spent in each phase of running a command.
+
+    ``phases`` is a list of ``(name, seconds)`` pairs in the order the
+    phases completed. ``factories`` maps command names to the time spent in
+    their factory and ``imports`` lists ``(module, self, cumulative)``
+    timings for the modules imported while loading a command's main.
+
+    If ``memory`` is true, ``memory`` lists ``(kind, name, peak, retained)``
+    for every phase and factory, where ``peak`` is the most memory in bytes
+    allocated at once during the block and ``retained`` is what was still
+    allocated at its end. Tracing is started on demand and stopped by
+    :meth:`reset`. Imports are not traced if ``imports`` is false.
+
+    """
+
+    def __init__(
+        self, format='table', clock=time.perf_counter, memory=False, imports=True
+    ):
+        self.format = format
+        self.clock = clock
+        self.trace_memory = memory
+        self.trace_import_times = imports
+        self._memory_stack = []
+        self._tracing = False
+        self.reset()
+
+    def reset(self):
+        self.phases = []
+        self.factories = {}
+        self.imports = []
+        self.memory = []
+        if self._tracing and not self._memory_stack:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self._tracing = False
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        self._memory_enter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, self.clock() - start))
+            self._memory_exit('phase', name)
+
+    @contextmanager
+    def factory(self, name):
+        start = self.clock()
+        self._memory_enter()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            self.factories[name] = self.factories.get(name, 0.0) + elapsed
+            self._memory_exit('factory', name)
+
+    def _memory_enter(self):
+        if not self.trace_memory:
+            return
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset for each block, so remember the enclosing peak
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        # reset_peak is new in Python 3.9
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._memory_stack.append([current, current])
+
+    def _memory_exit(self, kind, name):
+        if not self.trace_memory:
+            return
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        start, enclosed_peak = self._memory_stack.pop()
+        peak = max(peak, enclosed_peak)
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        self.memory.append((kind, name, peak - start, current - start))
+
+    def enter_context(self, stack, cm):
+        """
+        Enter ``cm`` on the ``ExitStack``, timing both its enter and exit.
+
+        Callbacks on the stack run in reverse order, so the timer started
+        by the last callback is stopped by the first one when the stack
+        unwinds. Nothing is timed on exit if entering ``cm`` fails.
+
+        """
+        with self.phase('context_enter'):
+            with ExitStack() as pending:
+                context = pending.enter_context(cm)
+                entered = pending.pop_all()
+        stack.callback(self._stop, 'context_exit')
+        stack.push(entered)
+        stack.callback(self._start)
+        return context
+
+    def _start(self):
+        self._exit_start = self.clock()
+
+    def _stop(self, name):
+        self.phases.append((name, self.clock() - self._exit_start))
+
+    @contextmanager
+    def trace_imports(self):
+        """Attribute time to every module imported within the block."""
+        if not self.trace_import_times:
+            yield
+            return
+        original_import = builtins.__import__
+        stack = []
+
+        def traced_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level or name in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+            stack.append(0.0)
+            start = self.clock()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                elapsed = self.clock() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.imports.append((name, elapsed - children, elapsed))
+
+        builtins.__import__ = traced_import
+        try:
+            yield
+        finally:
+            builtins.__import__ = original_import
+
+    def as_dict(self):
+        return {
+            'phases': [
+                {'name': name, 'seconds': seconds} for name, seconds in self.phases
+            ],
+            'factories': [
+                {'name': name, 'seconds': seconds}
+                for name, seconds in sorted(
+                    self.factories.items(), key=lambda item: -item[1]
+                )
+            ],
+            'imports': [
+                {'module': module, 'self': own, 'cumulative': cumulative}
+                for module, own, cumulative in sorted(
+                    self.imports, key=lambda item: -item[2]
+                )
+            ],
+            'memory': [
+                {'kind': kind, 'name': name, 'peak': peak, 'retained': retained}
+                for kind, name, peak, retained in self.memory
+            ],
+        }
+
+    def report(self, file=None):
+        if file is None:
+            file = sys.stderr
+        data = self.as_dict()
+        if self.format == 'json':
+            json.dump(data, file, indent=2)
+            file.write('\n')
+            return
+
+        rows = [('phase', 'seconds', '')]
+        rows.extend((p['name'], f"{p['seconds']:.6f}", '') for p in data['phases'])
+        if data['factories']:
+            rows.append(('factory', 'seconds', ''))
+            rows.extend(
+                (f['name'], f"{f['seconds']:.6f}", '') for f in data['factories']
+            )
+        if data['imports']:
+            rows.append(('import', 'self', 'cumulative'))
+            rows.extend(
+                (i['module'], f"{i['self']:.6f}", f"{i['cumulative']:.6f}")
+                for i in data['imports']
+            )
+        if data['memory']:
+            rows.append(('memory', 'peak', 'retained'))
+            rows.extend(
+                (f"{m['kind']} {m['name']}", str(m['peak']), str(m['retained']))
+                for m in data['memory']
+            )
+        width = max(len(row[0]) for row in rows)
+        for name, first, second in rows:
+            file.write(f'{name:<{width}}  {first:>10}  {second:>10}'.rstrip() + '\n')
@@ -0,0 +1,224 @@
+"""
+A resident server that keeps a :class:`subparse.CLI` warm between runs.
+
+The server imports every command and main function once and then forks a
+child for each request. A thin client forwards its ``argv``, working
+directory, environment and standard streams over a local Unix socket and
+exits with the exit code of the command::
+
+    # myapp/server.py
+    from subparse.server import serve
+    from myapp.cli import cli
+
+    serve(cli, '/run/user/1000/myapp.sock')
+
+    # myapp/client.py
+    import sys
+    from subparse.server import run_client
+
+    sys.exit(run_client('/run/user/1000/myapp.sock'))
+
+"""
+import array
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import traceback
+
+MAX_REQUEST_SIZE = 1 << 16
+
+
+def preload(cli):
+    """Import the factory and main of every command and build the parser."""
+    from .core import load_factory
+
+    cli.compile()
+    for meta in cli.commands.values():
+        load_factory(meta)
+    cli.warmup()
+
+
+def serve(cli, path, preload_commands=True, max_requests=None):
+    """
+    Serve requests for ``cli`` on the Unix socket at ``path``.
+
+    Each request is executed in a forked child process so commands cannot
+    affect each other or the server. If ``max_requests`` is specified the
+    server will stop after accepting that many requests and waiting for
+    them to complete.
+
+    """
+    if preload_commands:
+        preload(cli)
+    remove_stale_socket(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    children = set()
+    try:
+        sock.bind(path)
+        sock.listen()
+        handled = 0
+        while max_requests is None or handled < max_requests:
+            conn, _ = sock.accept()
+            handled += 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                sock.close()
+                handle_connection(cli, conn)
+            conn.close()
+            children.add(pid)
+            reap_children(children)
+    finally:
+        sock.close()
+        os.unlink(path)
+        reap_children(children, block=True)
+
+
+def remove_stale_socket(path):
+    """
+    Remove a socket at ``path`` left behind by a server which has stopped.
+
+    Raises ``FileExistsError`` if ``path`` is not a socket and ``OSError``
+    with ``EADDRINUSE`` if a server is still listening on it.
+
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, 'refusing to replace a non-socket', path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'a server is already listening', path)
+
+
+def reap_children(children, block=False):
+    for pid in list(children):
+        done, _ = os.waitpid(pid, 0 if block else os.WNOHANG)
+        if done:
+            children.discard(pid)
+
+
+def handle_connection(cli, conn):  # pragma: no cover
+    """Run a single request in a forked child and exit."""
+    from .core import exit_code
+
+    code = 1
+    try:
+        request, fds = recv_request(conn)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        for target, fd in zip((0, 1, 2), fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False)
+        try:
+            code = cli.run(request['argv'])
+        except SystemExit as ex:
+            code = exit_code(ex)
+        except Exception:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(json.dumps({'exit_code': code}).encode('utf8') + b'\n')
+    finally:
+        # os._exit skips atexit, which would deliver the telemetry
+        if cli.telemetry is not None:
+            cli.telemetry.close()
+        os._exit(0)
+
+
+def run_client(path, argv=None, stdin=None, stdout=None, stderr=None, fallback=None):
+    """
+    Run a command on the server listening at ``path``.
+
+    The current working directory, environment and standard streams are
+    forwarded to the server. The streams may be overridden with file
+    objects or file descriptors. If the server cannot be reached and a
+    ``fallback`` callable is specified, it is called with ``argv`` instead.
+
+    Returns the exit code of the command.
+
+    """
+    if argv is None:  # pragma: no cover
+        argv = sys.argv[1:]
+    streams = [
+        _fileno(stdin, 0),
+        _fileno(stdout, 1),
+        _fileno(stderr, 2),
+    ]
+    request = {
+        'argv': [str(v) for v in argv],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            if fallback is None:
+                raise
+            return fallback(argv)
+        send_request(sock, request, streams)
+        response = read_line(sock)
+    if not response:
+        return 1
+    return json.loads(response)['exit_code']
+
+
+def _fileno(stream, default):
+    if stream is None:
+        return default
+    if isinstance(stream, int):
+        return stream
+    return stream.fileno()
+
+
+def send_request(sock, request, fds):
+    data = json.dumps(request).encode('utf8') + b'\n'
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    sent = sock.sendmsg([data], ancdata)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def recv_request(sock):
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(
+        MAX_REQUEST_SIZE, socket.CMSG_LEN(3 * fds.itemsize)
+    )
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[: len(payload) - (len(payload) % fds.itemsize)])
+    if not data.endswith(b'\n'):
+        data += read_line(sock)
+    return json.loads(data), list(fds)
+
+
+def read_line(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(MAX_REQUEST_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
@@ -0,0 +1,215 @@
+"""
+Per-invocation telemetry for :class:`subparse.CLI`.
+
+Pass ``telemetry=[sink, ...]`` to ``CLI`` to record an event for every
+command that is run. Events are buffered and handed to the sinks in
+batches by a background thread, so recording never blocks on I/O::
+
+    from subparse.telemetry import JSONLinesSink
+
+    cli = CLI(telemetry=[JSONLinesSink('~/.cache/myapp/usage.jsonl')])
+
+Each event is a JSON-serializable dict like::
+
+    {
+        "time": 1700000000.0,
+        "command": "migrate",
+        "argv": ["<arg>", "--dry-run", "--target=<value>"],
+        "phases": {"parse_args": 0.0004, "main": 0.25},
+        "exit_code": 0,
+        "exception": null
+    }
+
+Only the names of options are kept from ``argv``; every other argument,
+including a value attached to an option such as ``-pS3cr3t``, is replaced
+by a placeholder.
+
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+
+_instances = weakref.WeakSet()
+
+
+def argv_shape(argv):
+    """Return ``argv`` with everything but the option names replaced."""
+    shape = []
+    for arg in argv:
+        if arg.startswith('--'):
+            name, sep, _ = arg.partition('=')
+            shape.append(name + sep + ('<value>' if sep else ''))
+        elif arg.startswith('-') and arg != '-' and not arg[1:2].isdigit():
+            # a short option may be followed by its value, e.g. -pS3cr3t
+            shape.append(arg[:2] + ('<value>' if len(arg) > 2 else ''))
+        else:
+            shape.append('<arg>')
+    return shape
+
+
+def make_event(argv, meta, phases, exit_code, exception=None):
+    durations = {}
+    for name, seconds in phases:
+        durations[name] = durations.get(name, 0.0) + seconds
+    if exception is not None:
+        cls = type(exception)
+        exception = f'{cls.__module__}.{cls.__qualname__}'
+    return {
+        'time': time.time(),
+        'command': meta.name if meta is not None else None,
+        'argv': argv_shape(argv),
+        'phases': durations,
+        'exit_code': exit_code,
+        'exception': exception,
+    }
+
+
+class Telemetry:
+    """
+    Buffer events and deliver them to ``sinks`` on a background thread.
+
+    The buffer is flushed every ``flush_interval`` seconds, as soon as it
+    holds ``max_buffer`` events and when the interpreter exits. Errors
+    raised by the sinks are ignored. A forked child process starts with an
+    empty buffer and a thread of its own.
+
+    """
+
+    def __init__(self, sinks, flush_interval=1.0, max_buffer=100):
+        self.sinks = list(sinks)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._closed = False
+        self._after_fork()
+        _instances.add(self)
+
+    def _after_fork(self):
+        # also called in a forked child, which must not deliver the events
+        # of its parent and does not inherit its thread
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def record(self, event):
+        with self._lock:
+            if self._closed:
+                return
+            self._buffer.append(event)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='subparse-telemetry', daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.close)
+            if len(self._buffer) >= self.max_buffer:
+                self._wakeup.notify()
+
+    def flush(self):
+        """Deliver the buffered events to the sinks now."""
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        for sink in self.sinks:
+            try:
+                sink.emit(events)
+            except Exception:
+                pass
+
+    def close(self):
+        """Flush the remaining events and close the sinks."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed and len(self._buffer) < self.max_buffer:
+                    self._wakeup.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+
+def _reset_after_fork():  # pragma: no cover
+    for telemetry in list(_instances):
+        telemetry._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class MemorySink:
+    """Keep the events in :attr:`events`, useful for tests."""
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, events):
+        self.events.extend(events)
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink:
+    """Append each event to the file at ``path`` as a line of JSON."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def emit(self, events):
+        lines = ''.join(json.dumps(event) + '\n' for event in events)
+        with open(self.path, 'a', encoding='utf8') as fp:
+            fp.write(lines)
+
+    def close(self):
+        pass
+
+
+class SocketSink:
+    """
+    Send each event as a JSON datagram to the Unix socket at ``path``.
+
+    Events are dropped if nothing is listening on the socket.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+
+    def emit(self, events):
+        import socket
+
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        for event in events:
+            try:
+                self._sock.sendto(json.dumps(event).encode('utf8'), self.path)
+            except OSError:
+                pass
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
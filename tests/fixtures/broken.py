@@ -0,0 +1 @@
+raise RuntimeError('broken plugin')
@@ -0,0 +1,11 @@
+from subparse import command
+
+
+@command('tests.fixtures.foo')
+def zzz(parser):  # pragma: no cover
+    pass
+
+
+@command('tests.fixtures.foo')
+def aaa(parser):  # pragma: no cover
+    pass
@@ -0,0 +1,5 @@
+import tests.fixtures.profiled_dep  # noqa: F401
+
+
+def main(app, args):
+    app['fn'] = 'profiled'
@@ -0,0 +1,10 @@
+import threading
+
+started = threading.Event()
+release = threading.Event()
+started.set()
+assert release.wait(10)
+
+
+def main(context, args):
+    return 0
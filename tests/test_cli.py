@@ -1,3 +1,6 @@
+import os
+import sys
+
 import pytest
 
 
@@ -177,7 +180,7 @@ def test_blank_command(capsys):
     cli = make_cli()
 
     @cli.command('.fixtures.foo')
-    def foo(parser):
+    def foo(parser):  # pragma: no cover
         parser.add_argument('--bar', action='store_true')
 
     pytest.raises(SystemExit, cli.run, [])
@@ -253,3 +256,1858 @@ def test_load_entry_point():
     assert app['fn'].__name__ == 'main'
     assert app['args'].bar is False
     assert result == 0
+
+
+def test_lazy_only_calls_invoked_factory():
+    app = {}
+    called = []
+    cli = make_cli(context=app, lazy=True)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        called.append('foo')
+        parser.add_argument('--bar', action='store_true')
+
+    @cli.command('.fixtures.foo')
+    def other(parser):  # pragma: no cover
+        called.append('other')
+
+    result = cli.run(['foo', '--bar'])
+    assert app['bar'] is True
+    assert result == 0
+    assert called == ['foo']
+
+
+def test_lazy_help_lists_all_commands(capsys):
+    cli = make_cli(lazy=True)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):  # pragma: no cover
+        """Run foo."""
+        raise AssertionError
+
+    @cli.command('.fixtures.foo')
+    def bar(parser):  # pragma: no cover
+        """Run bar."""
+        raise AssertionError
+
+    pytest.raises(SystemExit, cli.run, ['--help'])
+    out, err = capsys.readouterr()
+    assert 'Run foo.' in out
+    assert 'Run bar.' in out
+
+
+def test_lazy_help_command(capsys):
+    cli = make_cli(lazy=True)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        parser.add_argument('--bar', action='store_true', help='enable bar')
+
+    pytest.raises(SystemExit, cli.run, ['help', 'foo'])
+    out, err = capsys.readouterr()
+    assert 'enable bar' in out
+
+
+def test_load_entry_point_cache(tmp_path, monkeypatch):
+    import importlib.metadata
+    import json
+
+    cache_file = str(tmp_path / 'commands.json')
+    cli = make_cli()
+    cli.load_commands_from_entry_point('cli.commands', cache_file=cache_file)
+    with open(cache_file) as fp:
+        data = json.load(fp)
+    assert data['commands'] == [
+        {
+            'factory': 'fakeapp.commands:foo',
+            'main': 'fakeapp.foo',
+            'name': 'foo',
+            'help': 'Hello world',
+            'description': 'Hello world\n\nThis is a long command.',
+            'context_kwargs': {},
+        }
+    ]
+
+    def entry_points():  # pragma: no cover
+        raise AssertionError('entry points should not be scanned')
+
+    monkeypatch.setattr(importlib.metadata, 'entry_points', entry_points)
+    app = {}
+    cli = make_cli(context=app, lazy=True)
+    cli.load_commands_from_entry_point('cli.commands', cache_file=cache_file)
+    assert cli.commands['foo'].factory == 'fakeapp.commands:foo'
+
+    result = cli.run(['foo', '--bar'])
+    assert app['fn'].__module__ == 'fakeapp.foo'
+    assert app['args'].call == 'foo'
+    assert app['args'].bar is True
+    assert result == 0
+
+
+def test_load_entry_point_cache_invalidated(tmp_path, monkeypatch):
+    import json
+
+    cache_file = tmp_path / 'commands.json'
+    cli = make_cli()
+    cli.load_commands_from_entry_point('cli.commands', cache_file=str(cache_file))
+    data = json.loads(cache_file.read_text())
+    data['commands'][0]['name'] = 'stale'
+    cache_file.write_text(json.dumps(data))
+
+    cli = make_cli()
+    cli.load_commands_from_entry_point('cli.commands', cache_file=str(cache_file))
+    assert list(cli.commands) == ['stale']
+
+    monkeypatch.setenv('SUBPARSE_REFRESH_CACHE', '1')
+    cli = make_cli()
+    cli.load_commands_from_entry_point('cli.commands', cache_file=str(cache_file))
+    assert list(cli.commands) == ['foo']
+    monkeypatch.delenv('SUBPARSE_REFRESH_CACHE')
+
+    data['commands'][0]['name'] = 'stale'
+    cache_file.write_text(json.dumps(data))
+    cli = make_cli()
+    cli.load_commands_from_entry_point(
+        'cli.commands', cache_file=str(cache_file), refresh=True
+    )
+    assert list(cli.commands) == ['foo']
+    assert json.loads(cache_file.read_text())['commands'][0]['name'] == 'foo'
+
+    data = json.loads(cache_file.read_text())
+    for fname in data['files']:
+        data['files'][fname] = 0
+    data['commands'][0]['name'] = 'stale'
+    cache_file.write_text(json.dumps(data))
+    cli = make_cli()
+    cli.load_commands_from_entry_point('cli.commands', cache_file=str(cache_file))
+    assert list(cli.commands) == ['foo']
+
+    for corrupt in ('[]', '{', json.dumps(dict(data, version=0))):
+        cache_file.write_text(corrupt)
+        cli = make_cli()
+        cli.load_commands_from_entry_point('cli.commands', cache_file=str(cache_file))
+        assert list(cli.commands) == ['foo']
+    assert json.loads(cache_file.read_text())['commands'][0]['name'] == 'foo'
+
+
+def test_manifest_skips_uncacheable_commands(tmp_path):
+    import types
+
+    from subparse import CommandMeta
+    from subparse.manifest import dump_command, write_manifest
+
+    from .fixtures.foo import foo, main
+
+    def local_factory(parser):  # pragma: no cover
+        pass
+
+    def copy_function(fn):
+        return types.FunctionType(fn.__code__, fn.__globals__, fn.__name__)
+
+    meta = CommandMeta(foo, main, 'foo', '', '', {})
+    assert dump_command(meta)['factory'] == 'tests.fixtures.foo:foo'
+    assert dump_command(meta)['main'] == 'tests.fixtures.foo:main'
+    assert dump_command(meta._replace(factory=local_factory)) is None
+    assert dump_command(meta._replace(main=lambda a, b: None)) is None
+    # a copy of foo is found by name but resolves to a different object
+    assert dump_command(meta._replace(factory=copy_function(foo))) is None
+    assert dump_command(meta._replace(context_kwargs={'x': object()})) is None
+    assert dump_command(meta._replace(context_kwargs={'x': (1,)})) is None
+
+    cache_file = tmp_path / 'commands.json'
+    bad = meta._replace(factory=local_factory)
+    assert not write_manifest(str(cache_file), 'cli.commands', [bad], [])
+    assert not cache_file.exists()
+    assert not write_manifest(str(tmp_path), 'cli.commands', [meta], [])
+
+
+def test_compiled_parser_is_reused():
+    app = {}
+    called = []
+    cli = make_cli(context=app)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        called.append('foo')
+        parser.add_argument('--bar', action='store_true')
+
+    parser = cli.compile()
+    assert cli.compile() is parser
+    assert cli.run(['foo', '--bar']) == 0
+    assert app['bar'] is True
+    assert cli.run(['foo']) == 0
+    assert app['bar'] is False
+    assert called == ['foo']
+
+    @cli.command('.fixtures.foo')
+    def baz(parser):
+        called.append('baz')
+
+    assert cli.compile() is not parser
+    assert called == ['foo', 'baz', 'foo']
+
+    parser = cli.compile()
+    cli.add_generic_option('--quiet', action='store_true')
+    assert cli.compile() is not parser
+
+    parser = cli.compile()
+    cli.invalidate()
+    assert cli.compile() is not parser
+
+
+def _run_completion(cli, monkeypatch, comp_line, **env):
+    import io
+
+    monkeypatch.setenv('_ARGCOMPLETE', '1')
+    monkeypatch.setenv('COMP_LINE', comp_line)
+    monkeypatch.setenv('COMP_POINT', str(len(comp_line)))
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+
+    from subparse import autocomplete
+
+    out = io.StringIO()
+    exits = []
+    autocomplete(cli, output_stream=out, exit_method=exits.append)
+    return out.getvalue(), exits
+
+
+def test_autocomplete_command_names(monkeypatch):
+    called = []
+    cli = make_cli()
+
+    for name in ('foo', 'foobar', 'bar'):
+
+        def factory(parser):  # pragma: no cover
+            called.append(parser)
+
+        cli.add_command(factory, '.fixtures.foo', name=name)
+
+    out, exits = _run_completion(cli, monkeypatch, 'prog fo')
+    assert out.split('\013') == ['foo', 'foobar']
+    assert exits == [0]
+
+    out, exits = _run_completion(cli, monkeypatch, 'prog ')
+    assert out.split('\013') == ['bar', 'foo', 'foobar', 'help']
+
+    out, exits = _run_completion(cli, monkeypatch, 'prog help b')
+    assert out.split('\013') == ['bar']
+
+    out, exits = _run_completion(
+        cli, monkeypatch, 'prog b', _ARGCOMPLETE_SHELL='zsh', _ARGCOMPLETE_IFS='\n'
+    )
+    assert out == 'bar:'
+    assert called == []
+
+
+def test_autocomplete_builds_selected_command_only(monkeypatch):
+    called = []
+    cli = make_cli(lazy=True)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        called.append('foo')
+        parser.add_argument('--bar', action='store_true')
+
+    @cli.command('.fixtures.foo')
+    def other(parser):  # pragma: no cover
+        called.append('other')
+
+    out, exits = _run_completion(cli, monkeypatch, 'prog foo --b')
+    assert out == ''
+    assert exits == []
+    assert called == ['foo']
+
+    out, exits = _run_completion(cli, monkeypatch, 'prog --b')
+    assert called == ['foo']
+
+
+def test_autocomplete_from_run(monkeypatch, capsys):
+    cli = make_cli()
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):  # pragma: no cover
+        pass
+
+    monkeypatch.setenv('_ARGCOMPLETE', '1')
+    monkeypatch.setenv('COMP_LINE', 'prog --b')
+    monkeypatch.setenv('COMP_POINT', '8')
+    pytest.raises(SystemExit, cli.run, ['--b'])
+
+
+def test_run_many_shares_context(capsys):
+    out = []
+    calls = []
+
+    def context_factory(cli, args, tag=None):
+        out.append(('enter', tag))
+        yield calls
+        out.append(('exit', tag))
+
+    cli = make_cli(context_factory=context_factory)
+
+    @cli.command(__name__ + ':record_main')
+    def foo(parser):
+        parser.add_argument('--bar', action='store_true')
+
+    @cli.command(__name__ + ':record_main', context_kwargs={'tag': 'x'})
+    def tagged(parser):
+        pass
+
+    results = cli.run_many(
+        iter([['foo'], ['tagged'], ['foo', '--missing'], ['foo', '--bar']])
+    )
+    assert results == [0, 0, 2, 0]
+    assert out == [('enter', None), ('enter', 'x'), ('exit', 'x'), ('exit', None)]
+    assert [args.bar for args in calls if hasattr(args, 'bar')] == [False, True]
+    _, err = capsys.readouterr()
+    assert 'usage:' in err
+
+
+def test_run_many_stop_on_error():
+    calls = []
+    cli = make_cli(context=calls)
+
+    @cli.command(__name__ + ':record_main')
+    def foo(parser):
+        parser.add_argument('--code', type=int, default=0)
+
+    results = cli.run_many(
+        [['foo'], ['foo', '--code', '3'], ['foo']], stop_on_error=True
+    )
+    assert results == [0, 3]
+    assert len(calls) == 2
+    assert cli.run_many([['help']]) == [0]
+
+
+def exit_main(context, args):
+    sys.exit(3)
+
+
+def interrupt_main(context, args):
+    raise KeyboardInterrupt
+
+
+def test_run_many_handle_errors(capsys):
+    cli = make_cli(context={})
+    cli.add_command(lambda parser: None, exit_main, name='exit')
+    cli.add_command(lambda parser: None, interrupt_main, name='interrupt')
+    cli.add_command(lambda parser: None, failing_main, name='fail')
+    argvs = [['exit'], ['interrupt'], ['fail']]
+    assert cli.run_many(argvs, handle_errors=True) == [3, 130, 1]
+    out, err = capsys.readouterr()
+    assert 'KeyboardInterrupt' in err
+    assert 'ZeroDivisionError' in err
+
+    for argv, error in zip(argvs, (SystemExit, KeyboardInterrupt, ZeroDivisionError)):
+        pytest.raises(error, cli.run_many, [argv])
+
+
+def test_batch_command(tmp_path, monkeypatch):
+    import io
+
+    calls = []
+    cli = make_cli(context=calls, add_batch_command=True)
+
+    @cli.command(__name__ + ':record_main')
+    def foo(parser):
+        parser.add_argument('--code', type=int, default=0)
+        parser.add_argument('--name')
+
+    script = tmp_path / 'script.txt'
+    script.write_text(
+        '# deploy\n'
+        'foo --name "a b"\n'
+        '\n'
+        'foo --code 4  # fails\n'
+        'foo --name c\n'
+    )
+    assert cli.run(['batch', str(script)]) == 4
+    assert [args.name for args in calls] == ['a b', None, 'c']
+
+    del calls[:]
+    assert cli.run(['batch', '--stop-on-error', str(script)]) == 4
+    assert len(calls) == 2
+
+    del calls[:]
+    monkeypatch.setattr('sys.stdin', io.StringIO('foo\nfoo --name d\n'))
+    assert cli.run(['batch', '-']) == 0
+    assert [args.name for args in calls] == [None, 'd']
+
+
+def test_batch_command_reports_failures(tmp_path, capsys):
+    calls = []
+    cli = make_cli(context=calls, add_batch_command=True, prog='app')
+
+    @cli.command(__name__ + ':record_main')
+    def foo(parser):
+        parser.add_argument('--code', type=int, default=0)
+
+    cli.add_command(lambda parser: None, failing_main, name='fail')
+    script = tmp_path / 'script.txt'
+    script.write_text('foo\nfoo "unbalanced\nfail\nfoo --code 3\nfoo\n')
+    assert cli.run(['batch', str(script)]) == 2
+    assert len(calls) == 3
+    err = capsys.readouterr().err
+    assert 'ZeroDivisionError' in err
+    assert 'app batch: line 2: No closing quotation' in err
+    assert err.splitlines()[-3:] == [
+        'app batch: line 2: exit code 2: foo "unbalanced',
+        'app batch: line 3: exit code 1: fail',
+        'app batch: line 4: exit code 3: foo --code 3',
+    ]
+
+    del calls[:]
+    assert cli.run(['batch', '--stop-on-error', str(script)]) == 2
+    assert len(calls) == 1
+
+
+def test_batch_command_bad_options(capsys):
+    cli = make_cli(add_batch_command=True)
+    pytest.raises(SystemExit, cli.run, ['batch'])
+    out, err = capsys.readouterr()
+    assert 'usage:' in err
+
+
+def test_exit_code():
+    from subparse import exit_code
+
+    assert exit_code(SystemExit()) == 0
+    assert exit_code(SystemExit(5)) == 5
+    assert exit_code(SystemExit('failed')) == 1
+
+
+def record_main(calls, args):
+    calls.append(args)
+    return getattr(args, 'code', 0)
+
+
+def echo_main(context, args):  # pragma: no cover
+    print(os.getcwd(), os.environ.get('SUBPARSE_TEST'), args.words)
+    print(sys.stdin.read().strip(), file=sys.stderr)
+    return args.code
+
+
+def test_server_keeps_existing_files(tmp_path):
+    import errno
+    import socket
+
+    from subparse.server import serve
+
+    cli = make_cli()
+    path = tmp_path / 'cli.sock'
+    path.write_text('data')
+    pytest.raises(FileExistsError, serve, cli, str(path))
+    assert path.read_text() == 'data'
+
+    path.unlink()
+    live = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    live.bind(str(path))
+    live.listen()
+    try:
+        with pytest.raises(OSError) as excinfo:
+            serve(cli, str(path))
+        assert excinfo.value.errno == errno.EADDRINUSE
+        assert path.exists()
+    finally:
+        live.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_server_round_trip(tmp_path, monkeypatch):
+    import json
+    import socket
+    import threading
+    import time
+
+    from subparse.server import run_client, serve
+    from subparse.telemetry import JSONLinesSink
+
+    events = tmp_path / 'events.jsonl'
+    cli = make_cli(telemetry=[JSONLinesSink(str(events))])
+
+    @cli.command(__name__ + ':echo_main')
+    def echo(parser):
+        parser.add_argument('words', nargs='*')
+        parser.add_argument('--code', type=int, default=0)
+
+    # the children do not inherit the telemetry thread of the server
+    pytest.raises(SystemExit, cli.run, ['missing'])
+
+    # a stale socket left behind by a previous server is replaced
+    path = tmp_path / 'cli.sock'
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    st = path.stat()
+    stale_id = (st.st_ino, st.st_ctime_ns)
+    server = threading.Thread(
+        target=serve, args=(cli, str(path)), kwargs={'max_requests': 2}
+    )
+    server.start()
+    try:
+        for _ in range(500):  # pragma: no branch
+            try:
+                st = path.stat()
+            except FileNotFoundError:  # pragma: no cover
+                pass
+            else:
+                if (st.st_ino, st.st_ctime_ns) != stale_id:
+                    break
+            time.sleep(0.01)  # pragma: no cover
+
+        workdir = tmp_path / 'work'
+        workdir.mkdir()
+        monkeypatch.chdir(workdir)
+        monkeypatch.setenv('SUBPARSE_TEST', 'hello')
+        stdin = tmp_path / 'stdin'
+        stdin.write_text('from stdin\n')
+        stdout = tmp_path / 'stdout'
+        stderr = tmp_path / 'stderr'
+        with open(stdin) as i, open(stdout, 'w') as o, open(stderr, 'w') as e:
+            code = run_client(
+                str(path),
+                ['echo', 'a', 'b', '--code', '3'],
+                stdin=i,
+                stdout=o,
+                stderr=e,
+            )
+        assert code == 3
+        assert stdout.read_text() == f"{workdir} hello ['a', 'b']\n"
+        assert stderr.read_text() == 'from stdin\n'
+
+        with open(stdin) as i, open(stdout, 'w') as o, open(stderr, 'w') as e:
+            code = run_client(str(path), ['missing'], stdin=i, stdout=o, stderr=e)
+        assert code == 2
+        assert 'usage:' in stderr.read_text()
+    finally:
+        server.join(timeout=10)
+    assert not path.exists()
+    cli.telemetry.close()
+    codes = [json.loads(line)['exit_code'] for line in events.read_text().splitlines()]
+    assert sorted(codes) == [2, 2, 3]
+
+
+def test_server_protocol(tmp_path):
+    import socket
+    import threading
+
+    from subparse.server import (
+        MAX_REQUEST_SIZE,
+        recv_request,
+        remove_stale_socket,
+        run_client,
+        send_request,
+    )
+
+    # nothing to remove
+    remove_stale_socket(str(tmp_path / 'missing.sock'))
+
+    # requests larger than a single read are reassembled with their fds
+    left, right = socket.socketpair()
+    # with a timeout the first send stops once the socket buffer is full
+    left.settimeout(10)
+    request = {'argv': ['x' * MAX_REQUEST_SIZE] * 16}
+    with left, right, open(os.devnull) as null:
+        sender = threading.Thread(
+            target=send_request, args=(left, request, [null.fileno()])
+        )
+        sender.start()
+        received, fds = recv_request(right)
+        sender.join()
+        assert received == request
+        assert len(fds) == 1
+        os.close(fds[0])
+
+    # a server which hangs up without responding
+    path = str(tmp_path / 'cli.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def hang_up():
+        conn, _ = server.accept()
+        with conn:
+            _, fds = recv_request(conn)
+        for fd in fds:
+            os.close(fd)
+
+    thread = threading.Thread(target=hang_up)
+    thread.start()
+    with server:
+        assert run_client(path, ['foo'], stdin=0, stdout=1, stderr=2) == 1
+        thread.join()
+
+
+def test_server_client_fallback(tmp_path):
+    from subparse.server import run_client
+
+    path = str(tmp_path / 'missing.sock')
+    assert run_client(path, ['foo'], fallback=lambda argv: argv) == ['foo']
+    pytest.raises(OSError, run_client, path, ['foo'])
+
+
+class FakeEntryPoints:
+    def __init__(self, *entries):
+        from importlib.metadata import EntryPoint
+
+        self.entries = [EntryPoint(*entry) for entry in entries]
+
+    def select(self, group):
+        return [ep for ep in self.entries if ep.group == group]
+
+
+@pytest.mark.parametrize('max_workers', [None, 4])
+def test_load_entry_point_order(monkeypatch, max_workers):
+    import importlib.metadata
+
+    eps = FakeEntryPoints(
+        ('other', 'tests.fixtures.other', 'test.commands'),
+        ('foo', 'tests.fixtures.foo', 'test.commands'),
+        ('ignored', 'tests.fixtures.broken', 'test.ignored'),
+    )
+    monkeypatch.setattr(importlib.metadata, 'entry_points', lambda: eps)
+    cli = make_cli()
+    cli.load_commands_from_entry_point('test.commands', max_workers=max_workers)
+    assert list(cli.commands) == [
+        'zzz',
+        'aaa',
+        'foo',
+        'foo-main-dot',
+        'foo-main-absolute-colon',
+        'foo-main-dotted',
+        'foo-main-relative-leading-dot',
+        'foo-main-relative-leading-colon',
+        'bar',
+    ]
+
+
+@pytest.mark.parametrize('max_workers', [None, 4])
+def test_load_entry_point_error(monkeypatch, max_workers):
+    import importlib.metadata
+
+    eps = FakeEntryPoints(
+        ('foo', 'tests.fixtures.foo', 'test.commands'),
+        ('broken', 'tests.fixtures.broken', 'test.commands'),
+    )
+    monkeypatch.setattr(importlib.metadata, 'entry_points', lambda: eps)
+    cli = make_cli()
+    with pytest.raises(ImportError) as excinfo:
+        cli.load_commands_from_entry_point('test.commands', max_workers=max_workers)
+    assert 'broken = tests.fixtures.broken' in str(excinfo.value)
+    assert 'broken plugin' in str(excinfo.value)
+    assert isinstance(excinfo.value.__cause__, RuntimeError)
+
+
+def test_load_entry_point_on_demand(monkeypatch):
+    import importlib.metadata
+
+    eps = FakeEntryPoints(
+        ('foo', 'tests.fixtures.foo', 'test.commands'),
+        ('broken', 'tests.fixtures.broken', 'test.commands'),
+    )
+    monkeypatch.setattr(importlib.metadata, 'entry_points', lambda: eps)
+    app = {}
+    cli = make_cli(context=app)
+    cli.load_commands_from_entry_point('test.commands', on_demand=True)
+    assert cli.commands == {}
+
+    cli.run(['foo-main-absolute-colon', '--bar'])
+    assert app['fn'] == 'foo_main'
+    assert 'foo' in cli.commands
+    assert 'tests.fixtures.broken' not in sys.modules
+
+    # the help needs every command
+    pytest.raises(ImportError, cli.run, ['help'])
+
+
+def test_load_entry_point_on_demand_reused(monkeypatch, tmp_path):
+    import importlib.metadata
+
+    import subparse.core
+
+    eps = FakeEntryPoints(
+        ('foo', 'tests.fixtures.foo', 'test.commands'),
+        ('misc', 'tests.fixtures.other', 'test.commands'),
+    )
+    scans = []
+    builds = []
+    build_parser = subparse.core.build_parser
+    monkeypatch.setattr(
+        importlib.metadata, 'entry_points', lambda: scans.append(1) or eps
+    )
+    monkeypatch.setattr(
+        subparse.core,
+        'build_parser',
+        lambda *args, **kw: builds.append(1) or build_parser(*args, **kw),
+    )
+    cli = make_cli(context={})
+    cli.load_commands_from_entry_point('test.commands', on_demand=True)
+    assert cli.run_many([['foo']] * 5) == [0] * 5
+    assert len(scans) == len(builds) == 1
+    assert 'zzz' not in cli.commands
+
+    # the entry points which were loaded already are not loaded again
+    pytest.raises(SystemExit, cli.run, ['zzz', '--unknown'])
+    assert len(scans) == 1
+    assert list(cli.commands).count('zzz') == 1
+    assert cli._entry_points == []
+
+    cli = make_cli()
+    cli.load_commands_from_entry_point('test.commands', on_demand=True)
+    cli.compile()
+    assert 'foo' in cli.commands and 'zzz' in cli.commands
+    assert len(scans) == 2
+
+    # with a manifest no entry point is imported once it was written
+    path = str(tmp_path / 'manifest.json')
+    for expected_scans in (3, 3):
+        cli = make_cli(context={})
+        cli.load_commands_from_entry_point(
+            'test.commands', cache_file=path, on_demand=True
+        )
+        assert cli.run(['foo']) == 0
+        assert len(scans) == expected_scans
+        assert 'zzz' in cli.commands
+
+
+def test_load_entry_point_on_demand_fallback(monkeypatch, capsys):
+    import importlib.metadata
+
+    eps = FakeEntryPoints(
+        ('foo', 'tests.fixtures.foo', 'test.commands'),
+        ('misc', 'tests.fixtures.other', 'test.commands'),
+    )
+    monkeypatch.setattr(importlib.metadata, 'entry_points', lambda: eps)
+    cli = make_cli()
+    cli.load_commands_from_entry_point('test.commands', on_demand=True)
+    pytest.raises(SystemExit, cli.run, ['nope'])
+    assert 'invalid choice' in capsys.readouterr().err
+    assert list(cli.commands)[:3] == ['foo', 'foo-main-dot', 'foo-main-absolute-colon']
+    assert 'zzz' in cli.commands
+    assert cli._entry_points == []
+
+
+def test_profile_json(monkeypatch, capsys):
+    import json
+
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.profiled', raising=False)
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.profiled_dep', raising=False)
+
+    def context_factory(cli, args):
+        yield {}
+
+    cli = make_cli(context_factory=context_factory, profile='json')
+    cli.load_commands('.fixtures.foo')
+
+    @cli.command('tests.fixtures.profiled')
+    def profiled(parser):
+        pass
+
+    assert cli.run(['profiled']) == 0
+    out, err = capsys.readouterr()
+    data = json.loads(err)
+    assert [p['name'] for p in data['phases']] == [
+        'load_commands',
+        'build_parser',
+        'parse_args',
+        'context_enter',
+        'load_main',
+        'main',
+        'context_exit',
+    ]
+    assert {f['name'] for f in data['factories']} == set(cli.commands)
+    modules = [i['module'] for i in data['imports']]
+    assert modules == ['tests.fixtures.profiled', 'tests.fixtures.profiled_dep']
+    parent, child = data['imports']
+    assert parent['cumulative'] >= child['cumulative']
+    assert parent['self'] <= parent['cumulative']
+
+    # timings are reset after each run
+    pytest.raises(SystemExit, cli.run, ['profiled', '--missing'])
+    out, err = capsys.readouterr()
+    data = json.loads(err[err.index('{') :])
+    assert [p['name'] for p in data['phases']] == ['parse_args']
+
+
+def test_profile_context_enter_fails(capsys):
+    import json
+
+    calls = []
+
+    def context_factory(cli, args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise ValueError
+        yield {}
+
+    cli = make_cli(context_factory=context_factory, profile='json')
+    cli.load_commands('.fixtures.foo')
+    pytest.raises(ValueError, cli.run, ['foo'])
+    capsys.readouterr()
+
+    assert cli.run(['foo']) == 0
+    out, err = capsys.readouterr()
+    data = json.loads(err)
+    names = [p['name'] for p in data['phases']]
+    assert names.count('context_enter') == 1
+    assert names[-1] == 'context_exit'
+
+
+def test_profile_table_from_env(monkeypatch, capsys):
+    monkeypatch.setenv('SUBPARSE_PROFILE', '1')
+    cli = make_cli(lazy=True, context={})
+    cli.load_commands('.fixtures.foo')
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.profiled', raising=False)
+
+    @cli.command('tests.fixtures.profiled')
+    def profiled(parser):
+        pass
+
+    assert cli.run(['profiled']) == 0
+    out, err = capsys.readouterr()
+    lines = err.splitlines()
+    assert lines[0].split() == ['phase', 'seconds']
+    assert 'factory' in [line.split()[0] for line in lines]
+    assert lines[-1].split()[0] == 'tests.fixtures.profiled'
+
+    results = cli.run_many([['profiled'], ['profiled']])
+    assert results == [0, 0]
+    out, err = capsys.readouterr()
+    assert [line.split()[0] for line in err.splitlines()].count('main') == 2
+
+
+def test_profile_memory(capsys):
+    import json
+    import tracemalloc
+
+    app = {}
+    cli = make_cli(context=app, profile='json,memory')
+
+    def keep(app, args):
+        app['kept'] = bytearray(1 << 20)
+        bytearray(4 << 20)
+
+    def factory(parser):
+        pass
+
+    cli.add_command(factory, keep, name='keep')
+    assert cli.run(['keep']) == 0
+    out, err = capsys.readouterr()
+    data = json.loads(err)
+    memory = {(m['kind'], m['name']): m for m in data['memory']}
+    assert ('factory', 'keep') in memory
+    main = memory['phase', 'main']
+    assert main['retained'] >= 1 << 20
+    assert main['retained'] < 2 << 20
+    if hasattr(tracemalloc, 'reset_peak'):
+        assert main['peak'] >= 5 << 20
+    assert not tracemalloc.is_tracing()
+
+
+def test_profile_memory_table(capsys):
+    cli = make_cli(profile='memory')
+
+    def factory(parser):
+        pass
+
+    cli.add_command(factory, lambda app, args: None, name='noop')
+    assert cli.run(['noop']) == 0
+    out, err = capsys.readouterr()
+    assert 'memory' in err
+    assert 'phase main' in err
+    assert 'factory noop' in err
+
+
+def test_profile_disabled(monkeypatch):
+    monkeypatch.setenv('SUBPARSE_PROFILE', 'json')
+    cli = make_cli(profile=False)
+    assert cli.profiler is None
+
+
+def _imported_modules(code):
+    import subprocess
+
+    import subparse
+
+    env = dict(os.environ)
+    srcdir = os.path.dirname(os.path.dirname(subparse.__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [srcdir, env.get('PYTHONPATH')]))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return {
+        line.split('|')[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith('import time:') and '|' in line
+    }
+
+
+def test_import_command_is_cheap():
+    modules = _imported_modules('from subparse import command')
+    assert 'subparse.lazydecorator' in modules
+    for name in ('subparse.core', 'argparse', 'importlib.metadata', 'inspect'):
+        assert name not in modules
+
+
+def test_import_cli_defers_heavy_imports():
+    modules = _imported_modules('from subparse import CLI')
+    assert 'subparse.core' in modules
+    for name in ('importlib.metadata', 'inspect', 'shlex'):
+        assert name not in modules
+
+
+def test_missing_attribute():
+    import subparse
+
+    pytest.raises(AttributeError, getattr, subparse, 'missing')
+    pytest.raises(AttributeError, getattr, subparse, '__missing__')
+
+
+async def async_main(context, args):
+    import asyncio
+
+    await asyncio.sleep(0)
+    context['loops'].append(asyncio.get_running_loop())
+    return args.code
+
+
+def test_async_main_and_context():
+    import asyncio
+
+    out = []
+
+    async def context_factory(cli, args):
+        out.append(('enter', asyncio.get_running_loop()))
+        yield {'loops': out}
+        out.append(('exit', asyncio.get_running_loop()))
+
+    cli = make_cli(context_factory=context_factory)
+
+    @cli.command(__name__ + ':async_main')
+    def foo(parser):
+        parser.add_argument('--code', type=int, default=0)
+
+    assert cli.run(['foo', '--code', '2']) == 2
+    (_, enter_loop), main_loop, (_, exit_loop) = out
+    assert enter_loop is main_loop is exit_loop
+    assert enter_loop.is_closed()
+
+    del out[:]
+    assert cli.run_many([['foo'], ['foo', '--code', '1']]) == [0, 1]
+    loops = {id(item[1] if isinstance(item, tuple) else item) for item in out}
+    assert len(out) == 4
+    assert len(loops) == 1
+
+
+def test_async_context_sees_exception():
+    out = []
+
+    async def context_factory(cli, args):
+        try:
+            yield {'loops': []}
+        except ZeroDivisionError:
+            out.append('error')
+            raise
+
+    cli = make_cli(context_factory=context_factory)
+
+    @cli.command(__name__ + ':failing_main')
+    def foo(parser):
+        pass
+
+    pytest.raises(ZeroDivisionError, cli.run, ['foo'])
+    assert out == ['error']
+
+
+def test_async_context_can_suppress_exception():
+    async def context_factory(cli, args):
+        try:
+            yield {}
+        except ZeroDivisionError:
+            pass
+
+    cli = make_cli(context_factory=context_factory)
+
+    @cli.command(__name__ + ':failing_main')
+    def foo(parser):
+        pass
+
+    assert cli.run(['foo']) is None
+
+
+def test_coroutine_context_factory():
+    async def context_factory(cli, args):
+        return {'loops': []}
+
+    cli = make_cli(context_factory=context_factory)
+
+    @cli.command(__name__ + ':async_main')
+    def foo(parser):
+        parser.add_argument('--code', type=int, default=0)
+
+    assert cli.run(['foo']) == 0
+
+
+def test_event_loop_cancels_pending_tasks():
+    import asyncio
+
+    from subparse import EventLoop
+
+    loop = EventLoop()
+    loop.close()
+
+    async def start():
+        return asyncio.ensure_future(asyncio.sleep(10))
+
+    task = loop.run(start())
+    loop.close()
+    assert task.cancelled()
+
+
+def failing_main(context, args):
+    raise ZeroDivisionError
+
+
+def test_help_is_cached_without_calling_factories(capsys, monkeypatch):
+    monkeypatch.setenv('COLUMNS', '80')
+    called = []
+    cli = make_cli()
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        """Run foo."""
+        called.append('foo')
+        parser.add_argument('--bar', action='store_true', help='enable bar')
+
+    @cli.command('.fixtures.foo')
+    def other(parser):  # pragma: no cover
+        """Run other."""
+        called.append('other')
+
+    pytest.raises(SystemExit, cli.run, ['help'])
+    out, err = capsys.readouterr()
+    assert 'Run foo.' in out and 'Run other.' in out
+    assert called == []
+
+    pytest.raises(SystemExit, cli.run, ['foo', '--help'])
+    out, err = capsys.readouterr()
+    assert 'enable bar' in out
+    assert called == ['foo']
+
+    pytest.raises(SystemExit, cli.run, ['help', 'foo'])
+    assert capsys.readouterr()[0] == out
+    assert called == ['foo']
+
+    monkeypatch.setenv('COLUMNS', '40')
+    pytest.raises(SystemExit, cli.run, ['help', 'foo'])
+    assert called == ['foo', 'foo']
+
+    cli.invalidate()
+    pytest.raises(SystemExit, cli.run, ['help', 'foo'])
+    assert called == ['foo', 'foo', 'foo']
+
+
+def test_help_uses_compiled_parser(capsys):
+    cli = make_cli()
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        """Run foo."""
+
+    cli.compile()
+    pytest.raises(SystemExit, cli.run, [])
+    out, err = capsys.readouterr()
+    assert 'Run foo.' in err
+
+
+def test_help_cache_file(tmp_path, capsys, monkeypatch):
+    import json
+
+    monkeypatch.setenv('COLUMNS', '80')
+    cache_file = tmp_path / 'help.json'
+    called = []
+
+    def make():
+        cli = make_cli(help_cache_file=str(cache_file))
+        cli.add_generic_option('--quiet', action='store_true')
+
+        @cli.command('.fixtures.foo')
+        def foo(parser):
+            called.append('foo')
+            parser.add_argument('--bar', action='store_true', help='enable bar')
+
+        return cli
+
+    pytest.raises(SystemExit, make().run, ['help', 'foo'])
+    expected = capsys.readouterr()[0]
+    assert called == ['foo']
+    assert list(json.loads(cache_file.read_text())['help']) == ['80:foo']
+
+    pytest.raises(SystemExit, make().run, ['help', 'foo'])
+    assert capsys.readouterr()[0] == expected
+    assert called == ['foo']
+
+    pytest.raises(SystemExit, make().run, ['help'])
+    assert '--quiet' in capsys.readouterr()[0]
+    assert sorted(json.loads(cache_file.read_text())['help']) == ['80:', '80:foo']
+
+    # a change to the registry discards the cache
+    cli = make()
+    cli.add_generic_option('--verbose', action='store_true')
+    pytest.raises(SystemExit, cli.run, ['help', 'foo'])
+    assert called == ['foo', 'foo']
+
+    cache_file.write_text('[]')
+    pytest.raises(SystemExit, make().run, ['help', 'foo'])
+    assert called == ['foo', 'foo', 'foo']
+    cache_file.unlink()
+    pytest.raises(SystemExit, make().run, ['help', 'foo'])
+    assert called == ['foo', 'foo', 'foo', 'foo']
+
+
+def test_help_cache_key_of_manifest_commands():
+    from subparse import CommandMeta
+    from subparse.manifest import help_cache_key
+
+    from .fixtures.foo import main
+
+    keys = []
+    for factory in ('tests.fixtures.foo:foo', 'tests.fixtures.foo:main'):
+        cli = make_cli()
+        cli.commands['foo'] = CommandMeta(factory, main, 'foo', '', '', {})
+        keys.append(help_cache_key(cli))
+    assert keys[0] != keys[1]
+
+
+def test_resolved_mains_are_cached(monkeypatch):
+    app = {}
+    cli = make_cli(context=app)
+
+    @cli.command('.fixtures.foo:foo_main')
+    def foo(parser):
+        parser.add_argument('--bar', action='store_true')
+
+    from .fixtures import foo as foo_module
+
+    assert cli.run(['foo']) == 0
+    monkeypatch.setattr(foo_module, 'foo_main', None)
+    assert cli.run(['foo', '--bar']) == 0
+    assert app['bar'] is True
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_warmup(monkeypatch, background):
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.profiled', raising=False)
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.broken', raising=False)
+    cli = make_cli()
+
+    @cli.command('tests.fixtures.profiled')
+    def profiled(parser):  # pragma: no cover
+        pass
+
+    @cli.command('tests.fixtures.broken')
+    def broken(parser):  # pragma: no cover
+        pass
+
+    @cli.command(__name__ + ':record_main')
+    def record(parser):  # pragma: no cover
+        pass
+
+    thread = cli.warmup(['profiled', 'record'], background=background)
+    if background:
+        thread.join()
+    else:
+        assert thread is None
+    assert 'tests.fixtures.profiled' in sys.modules
+
+    if background:
+        cli.warmup(background=True).join()
+    else:
+        pytest.raises(RuntimeError, cli.warmup)
+    assert 'tests.fixtures.broken' not in sys.modules
+
+
+def test_overlap_main_import(monkeypatch):
+    import threading
+
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.slow_import', raising=False)
+    out = []
+
+    def context_factory(cli, args):
+        # the main module is imported while the context is being set up
+        module = None
+        for _ in range(1000):  # pragma: no branch
+            module = sys.modules.get('tests.fixtures.slow_import')
+            if module is not None and module.started.is_set():
+                break
+            threading.Event().wait(0.01)  # pragma: no cover
+        out.append(threading.current_thread())
+        module.release.set()
+        yield {}
+
+    cli = make_cli(context_factory=context_factory, overlap_main_import=True)
+
+    @cli.command('tests.fixtures.slow_import')
+    def foo(parser):
+        pass
+
+    assert cli.run(['foo']) == 0
+    assert out == [threading.main_thread()]
+    assert cli.run_many([['foo'], ['foo']]) == [0, 0]
+
+
+def test_overlap_main_import_errors(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'tests.fixtures.broken', raising=False)
+    out = []
+
+    def context_factory(cli, args, fail=False):
+        if fail:
+            raise ValueError('context failed')
+        try:
+            yield {}
+        except RuntimeError:
+            out.append('context saw import error')
+            raise
+
+    cli = make_cli(context_factory=context_factory, overlap_main_import=True)
+
+    @cli.command('tests.fixtures.broken')
+    def broken(parser):
+        pass
+
+    @cli.command('tests.fixtures.broken', context_kwargs={'fail': True})
+    def both(parser):
+        pass
+
+    pytest.raises(RuntimeError, cli.run, ['broken'])
+    assert out == ['context saw import error']
+    pytest.raises(ValueError, cli.run, ['both'])
+
+
+def test_command_meta_parses_docstring_lazily(monkeypatch, capsys):
+    import subparse.core
+
+    parsed = []
+    parse_docstring = subparse.core.parse_docstring
+
+    def counting_parse_docstring(docstring):
+        parsed.append(docstring)
+        return parse_docstring(docstring)
+
+    monkeypatch.setattr(subparse.core, 'parse_docstring', counting_parse_docstring)
+    app = {}
+    cli = make_cli(lazy=True, context=app)
+
+    @cli.command('.fixtures.foo')
+    def foo(parser):
+        """
+        Short foo.
+
+        Long foo.
+        """
+        parser.add_argument('--bar', action='store_true')
+
+    @cli.command('.fixtures.foo')
+    def other(parser):  # pragma: no cover
+        """Short other."""
+
+    cli.compile()
+    assert parsed == []
+    assert cli.run(['foo', '--bar']) == 0
+    assert len(parsed) == 1
+
+    meta = cli.commands['foo']
+    assert meta.help == 'Short foo.'
+    assert meta.description == 'Short foo.\n\nLong foo.'
+    assert meta.context_kwargs == {}
+
+    pytest.raises(SystemExit, cli.run, ['help'])
+    assert 'Short other.' in capsys.readouterr()[0]
+    assert len(parsed) == 2
+
+
+def test_command_meta_record():
+    from subparse import CommandMeta
+
+    meta = CommandMeta('mod:factory', 'mod', ''.join(['fo', 'o']), 'h', 'd', {'x': 1})
+    assert meta.name is sys.intern('foo')
+    assert meta._fields == (
+        'factory',
+        'main',
+        'name',
+        'help',
+        'description',
+        'context_kwargs',
+    )
+    assert meta._replace(help='other').help == 'other'
+    assert meta._replace(help='h') == meta
+    assert meta != meta._replace(context_kwargs=None)
+    assert meta != ('mod:factory',)
+    assert repr(meta) == (
+        "CommandMeta(factory='mod:factory', main='mod', name='foo', help='h', "
+        "description='d', context_kwargs={'x': 1})"
+    )
+    assert not hasattr(meta, '__dict__')
+    assert CommandMeta('mod:factory', 'mod', 'foo').help == ''
+
+
+def test_nested_groups_load_on_demand(capsys):
+    app = {}
+    loaded = []
+    cli = make_cli(context=app)
+
+    def load_db(db):
+        loaded.append('db')
+
+        @db.command('.fixtures.foo')
+        def migrate(parser):
+            """Migrate the database."""
+            parser.add_argument('--bar', action='store_true')
+
+    def load_cache(cache):  # pragma: no cover
+        loaded.append('cache')
+
+    cli.add_group('db', loader=load_db, help='Manage the database.')
+    cli.add_group('cache', loader=load_cache, help='Manage the cache.')
+
+    pytest.raises(SystemExit, cli.run, ['help'])
+    out, err = capsys.readouterr()
+    assert 'Manage the database.' in out
+    assert 'Manage the cache.' in out
+    assert loaded == []
+
+    cli.run(['db', 'migrate', '--bar'])
+    assert app['fn'] == 'main'
+    assert app['bar'] is True
+    assert loaded == ['db']
+
+    pytest.raises(SystemExit, cli.run, ['db', '--help'])
+    out, err = capsys.readouterr()
+    assert 'Migrate the database.' in out
+    assert loaded == ['db']
+
+
+def test_group_options(monkeypatch, capsys):
+    import importlib.metadata
+    import json
+
+    eps = FakeEntryPoints(('foo', 'tests.fixtures.foo', 'test.commands'))
+    monkeypatch.setattr(importlib.metadata, 'entry_points', lambda: eps)
+    app = {}
+    cli = make_cli(context=app, profile='json')
+    db = cli.add_group('db', entry_point='test.commands')
+    db.add_generic_option('--dsn')
+
+    cli.run(['db', '--dsn', 'x', 'bar'])
+    assert app['fn'] == 'bar_main'
+    out, err = capsys.readouterr()
+    assert 'db' in [f['name'] for f in json.loads(err)['factories']]
+
+    # a group without a command prints the usage
+    with pytest.raises(SystemExit) as excinfo:
+        cli.run(['db', '--dsn', 'x'])
+    assert excinfo.value.code == 2
+    assert capsys.readouterr().err.startswith('usage:')
+
+    # completion builds the parser of the selected group only
+    out, exits = _run_completion(cli, monkeypatch, 'prog db --dsn x bar --b')
+    assert out == ''
+    assert exits == []
+
+
+def test_nested_group_from_module():
+    app = {}
+    cli = make_cli(context=app)
+    tools = cli.add_group('tools', commands='.fixtures.foo')
+    assert tools.commands == {}
+    assert tools.prog is None
+
+    cli.run(['tools', 'bar', '--bar'])
+    assert app['fn'] == 'bar_main'
+    assert 'foo' in tools.commands
+
+    inner = tools.add_group('inner')
+
+    @inner.command('.fixtures.foo')
+    def foo(parser):
+        parser.add_argument('--bar', action='store_true')
+
+    # the parent's compiled parser is discarded
+    assert cli._parser is None
+    cli.run(['tools', 'inner', 'foo'])
+    assert app['fn'] == 'main'
+
+
+def test_telemetry(capsys):
+    from subparse.telemetry import MemorySink
+
+    sink = MemorySink()
+    cli = make_cli(context={}, telemetry=[sink])
+    cli.load_commands('.fixtures.foo')
+    cli.add_command(lambda parser: None, failing_main, name='fail')
+
+    assert cli.run(['foo', '--bar']) == 0
+    pytest.raises(ZeroDivisionError, cli.run, ['fail'])
+    pytest.raises(SystemExit, cli.run, ['foo', 'secret'])
+    assert cli.run_many([['bar'], ['bar', '--bar']]) == [0, 0]
+    cli.telemetry.close()
+    assert capsys.readouterr().err.startswith('usage:')
+
+    ok, failed, bad, first, second = sink.events
+    assert ok['command'] == 'foo'
+    assert ok['argv'] == ['<arg>', '--bar']
+    assert ok['exit_code'] == 0
+    assert ok['exception'] is None
+    assert {'build_parser', 'parse_args', 'main'} <= set(ok['phases'])
+    assert failed['command'] == 'fail'
+    assert failed['exit_code'] == 1
+    assert failed['exception'] == 'builtins.ZeroDivisionError'
+    assert bad['command'] is None
+    assert bad['argv'] == ['<arg>', '<arg>']
+    assert bad['exit_code'] == 2
+    assert first['command'] == second['command'] == 'bar'
+    assert 'context_enter' in first['phases']
+    assert 'context_enter' not in second['phases']
+
+
+def test_telemetry_sinks(tmp_path):
+    import json
+    import socket
+
+    from subparse.telemetry import JSONLinesSink, SocketSink, Telemetry, argv_shape
+
+    assert argv_shape(['a', '-', '-1', '-x', '--y=1', '-pS3cr3t', '--']) == [
+        '<arg>',
+        '<arg>',
+        '<arg>',
+        '-x',
+        '--y=<value>',
+        '-p<value>',
+        '--',
+    ]
+
+    path = str(tmp_path / 'events.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    telemetry = Telemetry(
+        [JSONLinesSink(str(tmp_path / 'events.jsonl')), SocketSink(path)],
+        max_buffer=2,
+    )
+    cli = make_cli(context={}, telemetry=telemetry)
+    cli.load_commands('.fixtures.foo')
+    cli.run(['foo'])
+    cli.run(['bar'])
+    server.settimeout(5)
+    assert json.loads(server.recv(4096))['command'] == 'foo'
+    assert json.loads(server.recv(4096))['command'] == 'bar'
+    server.close()
+    telemetry.close()
+    with open(tmp_path / 'events.jsonl') as fp:
+        assert [json.loads(line)['command'] for line in fp] == ['foo', 'bar']
+
+
+def test_telemetry_errors(tmp_path):
+    from subparse.telemetry import MemorySink, SocketSink, Telemetry
+
+    class BrokenSink:
+        def emit(self, events):
+            raise OSError
+
+        def close(self):
+            raise OSError
+
+    sink = MemorySink()
+    # nothing listens on the socket
+    unbound = SocketSink(str(tmp_path / 'missing.sock'))
+    telemetry = Telemetry([BrokenSink(), unbound, sink], flush_interval=60)
+    telemetry.record({'n': 1})
+    telemetry.close()
+    telemetry.close()
+    telemetry.record({'n': 2})
+    assert sink.events == [{'n': 1}]
+
+
+def target_main(context, args):
+    print(args.target, context['pid'])
+    if args.target == 'bad':
+        raise ValueError('bad target')
+    if args.target == 'exit':
+        sys.exit(4)
+    return 3 if args.target == 'three' else 0
+
+
+def test_run_parallel(tmp_path, capsys):
+    entered = tmp_path / 'entered'
+
+    def context_factory(cli, args):
+        with open(entered, 'a') as fp:
+            fp.write(f'{os.getpid()}\n')
+        yield {'pid': os.getpid()}
+
+    cli = make_cli(context_factory=context_factory)
+    cli.add_command(lambda parser: None, target_main, name='ping')
+    targets = [f'host{i}' for i in range(6)] + ['three', 'bad']
+    results = cli.run_parallel(['ping'], targets, jobs=2)
+    assert results == [0] * 6 + [3, 1]
+    out, err = capsys.readouterr()
+    lines = [line.split() for line in out.splitlines()]
+    assert [line[0] for line in lines] == targets
+    pids = {line[1] for line in lines}
+    # each worker enters the context once, even if it runs no targets
+    workers = entered.read_text().split()
+    assert len(workers) == len(set(workers)) <= 2
+    assert pids <= set(workers)
+    assert str(os.getpid()) not in pids
+    assert 'ValueError: bad target' in err
+
+    results = cli.run_parallel(['ping'], targets, jobs=3, ordered=False)
+    assert results == [0] * 6 + [3, 1]
+    out, err = capsys.readouterr()
+    assert sorted(line.split()[0] for line in out.splitlines()) == sorted(targets)
+
+
+def test_run_parallel_errors(capsys):
+    def context_factory(cli, args):
+        if args.fail:
+            raise ValueError('no context')
+        return {'pid': 0}
+
+    cli = make_cli(context_factory=context_factory)
+    cli.add_command(
+        lambda parser: parser.add_argument('--fail', action='store_true'),
+        target_main,
+        name='ping',
+    )
+    assert cli.run_parallel(['ping'], []) == []
+    assert cli.run_parallel(['ping'], ['exit', 'a'], jobs=1) == [4, 0]
+    assert capsys.readouterr().out == 'exit 0\na 0\n'
+
+    # a worker which failed to start reports the error for every target
+    assert cli.run_parallel(['ping', '--fail'], ['a', 'b'], jobs=1) == [1, 1]
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert err.count('ValueError: no context') == 2
+
+
+def test_fan_out_option(tmp_path, capsys, monkeypatch):
+    import io
+
+    cli = make_cli(context={'pid': 0}, add_fan_out_options=True)
+    cli.add_command(lambda parser: None, target_main, name='ping')
+    path = tmp_path / 'targets'
+    path.write_text('# hosts\na\n\nb\n')
+    assert cli.run(['--fan-out', str(path), '--jobs', '2', 'ping']) == 0
+    assert capsys.readouterr().out == 'a 0\nb 0\n'
+    path.write_text('a\nthree\n')
+    assert cli.run(['--fan-out', str(path), 'ping']) == 3
+    capsys.readouterr()
+
+    # commands run together fan out too
+    path.write_text('c\n')
+    assert cli.run_many([['--fan-out', str(path), 'ping']] * 2) == [0, 0]
+    assert capsys.readouterr().out == 'c 0\nc 0\n'
+
+    monkeypatch.setattr('sys.stdin', io.StringIO('d\ne\n'))
+    assert cli.run(['--fan-out', '-', 'ping']) == 0
+    assert capsys.readouterr().out == 'd 0\ne 0\n'
+
+
+def export_main(context, args):
+    assert args.records is None
+    for i in range(args.count):
+        context['exported'] += 1
+        yield i
+
+
+def transform_main(context, args):
+    for record in args.records:
+        yield record * args.factor
+
+
+def load_main(context, args):
+    for record in args.records:
+        # records are streamed one at a time
+        assert context['exported'] == len(context['loaded']) + 1
+        context['loaded'].append(record)
+    return args.code
+
+
+def make_pipeline_cli(context, entered):
+    def context_factory(cli, args):
+        entered.append(args)
+        return context
+
+    cli = make_cli(context_factory=context_factory, add_pipelines=True)
+    cli.add_command(
+        lambda parser: parser.add_argument('--count', type=int, default=3),
+        export_main,
+        name='export',
+    )
+    cli.add_command(
+        lambda parser: parser.add_argument('--factor', type=int, default=2),
+        transform_main,
+        name='transform',
+    )
+    cli.add_command(
+        lambda parser: parser.add_argument('--code', type=int, default=0),
+        load_main,
+        name='load',
+    )
+    return cli
+
+
+def test_pipeline():
+    entered = []
+    loaded = []
+    context = {'exported': 0, 'loaded': loaded}
+    cli = make_pipeline_cli(context, entered)
+
+    argv = ['export', '--count', '4', '--', 'transform', '--', 'load', '--code', '5']
+    assert cli.run(argv) == 5
+    assert loaded == [0, 2, 4, 6]
+    assert len(entered) == 1
+    assert entered[0].count == 4
+
+    loaded.clear()
+    context['exported'] = 0
+    assert cli.run_pipeline([['export'], ['transform', '--factor', '3']]) == 0
+    assert loaded == []
+    assert context['exported'] == 3
+
+
+def test_pipeline_stage_results():
+    entered = []
+    loaded = []
+    context = {'exported': 0, 'loaded': loaded}
+    cli = make_pipeline_cli(context, entered)
+    cli.add_command(lambda parser: None, lambda context, args: None, name='noop')
+    cli.add_command(lambda parser: None, failing_main, name='fail')
+
+    # a stage returning nothing or zero passes no records on
+    assert cli.run(['noop', '--', 'transform', '--', 'load', '--code', '4']) == 4
+    assert cli.run(['noop', '--', 'load', '--', 'load', '--code', '5']) == 5
+    assert loaded == []
+
+    # a failing stage stops the pipeline
+    assert cli.run(['noop', '--', 'load', '--code', '3', '--', 'noop']) == 3
+    pytest.raises(ZeroDivisionError, cli.run, ['fail', '--', 'load'])
+
+
+def test_pipeline_parses_every_command_first(capsys):
+    entered = []
+    cli = make_pipeline_cli({}, entered)
+    pytest.raises(SystemExit, cli.run, ['export', '--', 'missing'])
+    assert entered == []
+    assert 'invalid choice' in capsys.readouterr().err
+
+
+def test_context_cache(tmp_path, monkeypatch):
+    import stat
+
+    from subparse.contextcache import ContextCache
+
+    now = [1000.0]
+    path = str(tmp_path / 'context.json')
+    calls = []
+
+    def make_cache():
+        return ContextCache(path, ttl=60, options=['bar'], clock=lambda: now[0])
+
+    def context_factory(cli, args, **kw):
+        calls.append(kw)
+        return {'fn': None, 'calls': len(calls)}
+
+    def make_cached_cli():
+        cli = make_cli(context_factory=make_cache()(context_factory))
+        cli.add_command(
+            lambda parser: parser.add_argument('--bar', action='store_true'),
+            lambda app, args: app['calls'],
+            name='foo',
+        )
+        cli.add_command(
+            lambda parser: parser.add_argument('--bar', action='store_true'),
+            lambda app, args: app['calls'],
+            name='other',
+            context_kwargs={'admin': True},
+        )
+        return cli
+
+    assert make_cached_cli().run(['foo']) == 1
+    # a new process reuses the stored context
+    assert make_cached_cli().run(['foo']) == 1
+    assert make_cached_cli().run(['foo', '--bar']) == 2
+    assert make_cached_cli().run(['other']) == 3
+    assert calls == [{}, {}, {'admin': True}]
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    now[0] += 61
+    assert make_cached_cli().run(['foo']) == 4
+
+    make_cache().invalidate()
+    assert make_cached_cli().run(['foo']) == 5
+    monkeypatch.setenv('SUBPARSE_REFRESH_CACHE', '1')
+    assert make_cached_cli().run(['foo']) == 6
+
+
+def test_context_cache_files(tmp_path):
+    import json
+    import stat
+
+    from subparse.contextcache import ContextCache
+
+    path = tmp_path / 'context.json'
+    cache = ContextCache(str(path))
+    # nothing to discard
+    cache.invalidate()
+
+    # a temporary file left behind by a process with the same pid
+    stale = tmp_path / f'context.json.{os.getpid()}.tmp'
+    stale.write_text('partial')
+    cache.set('key', 1)
+    assert cache.get('key') == (True, 1)
+    assert not stale.exists()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+    # results stored by another version are ignored
+    path.write_text(json.dumps({'version': 0, 'entries': {}}))
+    assert cache.get('key') == (False, None)
+
+    # failing to store a result is not an error
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    cache = ContextCache(str(blocker / 'context.json'))
+    cache.set('key', 1)
+    assert cache.get('key') == (False, None)
+    assert sorted(tmp_path.iterdir()) == [path, blocker]
+
+
+def test_context_cache_async(tmp_path):
+    from subparse.contextcache import ContextCache
+
+    cache = ContextCache(str(tmp_path / 'context.json'))
+    calls = []
+
+    @cache
+    async def context_factory(cli, args):
+        calls.append(args)
+        return {}
+
+    cli = make_cli(context_factory=context_factory)
+    cli.load_commands('.fixtures.foo')
+    cli.run(['foo'])
+    cli.run(['foo'])
+    assert len(calls) == 1
+
+    def generator_factory(cli, args):  # pragma: no cover
+        yield {}
+
+    pytest.raises(TypeError, cache, generator_factory)
+
+
+def test_shell(monkeypatch, capsys):
+    import io
+
+    entered = []
+
+    def context_factory(cli, args):
+        entered.append(args)
+        yield {}
+
+    cli = make_cli(context_factory=context_factory, add_shell_command=True)
+    cli.load_commands('.fixtures.foo')
+    cli.add_command(lambda parser: None, failing_main, name='fail')
+    lines = ['foo --bar', '# comment', '', 'fail', '"unbalanced', 'help', 'bar']
+    lines += ['exit', 'foo']
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(''.join(f'{x}\n' for x in lines)))
+    assert cli.run(['shell']) == 0
+    out, err = capsys.readouterr()
+    assert 'ZeroDivisionError' in err
+    assert 'error: No closing quotation' in err
+    assert 'foo-main-dot' in out
+    # one context for every command, the parser is compiled once
+    assert len(entered) == 1
+    assert cli._parser is not None
+    assert cli._mains
+
+    # the end of the input leaves the shell
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('foo'))
+    assert cli.run(['shell']) == 0
+    assert len(entered) == 2
+
+
+def test_shell_interactive(monkeypatch, capsys):
+    import builtins
+    import io
+
+    readline = pytest.importorskip('readline')
+
+    class Terminal(io.StringIO):
+        def isatty(self):
+            return True
+
+    entered = []
+    context = {'exported': 0, 'loaded': []}
+    cli = make_pipeline_cli(context, entered)
+    cli.add_shell_command = True
+    lines = [
+        '',
+        'export -- transform -- load',
+        KeyboardInterrupt,
+        'export --count x',
+        '',
+        'export --count 1 -- load',
+    ]
+    completions = []
+
+    def fake_input(prompt):
+        assert prompt.endswith('> ')
+        complete = readline.get_completer()
+        completions.append([complete('ex', 0), complete('ex', 1), complete('ex', 2)])
+        if not lines:
+            raise EOFError
+        line = lines.pop(0)
+        if line is KeyboardInterrupt:
+            raise line
+        return line
+
+    monkeypatch.setattr('sys.stdin', Terminal())
+    monkeypatch.setattr(builtins, 'input', fake_input)
+    previous = readline.get_completer()
+    # blank lines do not leave the shell
+    assert cli.run(['shell']) == 0
+    assert readline.get_completer() is previous
+    assert not lines
+    assert context['loaded'] == [0, 2, 4, 0]
+    assert len(entered) == 1
+    assert completions[0] == ['exit', 'export', None]
+    out, err = capsys.readouterr()
+    assert "argument --count: invalid int value: 'x'" in err
+
+    pytest.raises(SystemExit, cli.run, ['shell', 'extra'])
+    out, err = capsys.readouterr()
+    assert 'unrecognized arguments: extra' in err
+
+
+def test_shell_completion():
+    from subparse.core import complete_shell_line
+
+    cli = make_cli()
+    cli.load_commands('.fixtures.foo')
+    cli.add_group('db', loader=lambda db: None)
+    assert complete_shell_line(cli, 'foo-main-d', 'foo-main-d') == [
+        'foo-main-dot',
+        'foo-main-dotted',
+    ]
+    assert complete_shell_line(cli, '', '')[:3] == ['bar', 'db', 'exit']
+    assert complete_shell_line(cli, 'help d', 'd') == ['db']
+    parsers = {}
+    assert complete_shell_line(cli, 'bar --', '--', parsers) == ['--bar', '--help']
+    assert list(parsers) == ['bar']
+    assert complete_shell_line(cli, 'bar -h ', '', parsers) == ['--bar', '--help', '-h']
+    assert complete_shell_line(cli, 'db ', '') == []
@@ -0,0 +1,132 @@
+import argparse
+import sys
+
+import pytest
+
+from subparse import CLI
+from subparse.core import ArgumentParser
+from subparse.fastparse import FastArgumentParser, Unsupported
+
+# run every CLI test again using the fast parser
+from .test_cli import *  # noqa: F401,F403
+
+
+@pytest.fixture(autouse=True)
+def fast_parser(monkeypatch):
+    monkeypatch.setattr(CLI, '_ArgumentParser', FastArgumentParser)
+
+
+def build(parser_class):
+    parser = parser_class(prog='prog')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--name', default='anon')
+    parser.add_argument('--size', type=int, default='3')
+    parser.add_argument('--tag', action='append', default=[])
+    parser.add_argument('--level', choices=['low', 'high'])
+    parser.add_argument('-q', '--quiet', action='store_false', dest='loud')
+    parser.add_argument('--color', action='store_true')
+    parser.add_argument('--no-color', action='store_false', dest='color')
+    subparsers = parser.add_subparsers(dest='command', metavar='<command>')
+    run = subparsers.add_parser('run')
+    run.add_argument('target')
+    run.add_argument('--force', action='store_true')
+    run.add_argument('--retries', type=int)
+    run.set_defaults(handler='run')
+    multi = subparsers.add_parser('multi')
+    multi.add_argument('files', nargs='+')
+    return parser
+
+
+CASES = [
+    [],
+    ['-v', '-v', '--name', 'bob', '--size=5'],
+    ['--tag', 'a', '--tag=b', 'run', 'host'],
+    ['-q', 'run', '--force', 'host', '--retries', '2'],
+    ['--level', 'low', 'run', 'host', '--force'],
+    ['multi', 'a', 'b'],
+    ['--color'],
+    ['--color=yes'],
+    ['--color', '--no-color'],
+    ['--na', 'abbreviated'],
+    ['run', 'host', '--', '--force'],
+    ['--size', '-1'],
+    ['run', 'host', 'extra'],
+    ['--size', 'x'],
+    ['--level', 'medium'],
+    ['run'],
+    ['missing'],
+    ['run', 'host', '--unknown'],
+]
+
+
+@pytest.mark.parametrize('argv', CASES)
+def test_same_result_as_argparse(argv):
+    def parse(parser_class):
+        try:
+            return build(parser_class).parse_known_args(argv)
+        except argparse.ArgumentError as ex:
+            return str(ex)
+
+    assert parse(FastArgumentParser) == parse(ArgumentParser)
+
+
+def test_uses_fast_path(monkeypatch):
+    def fail(*args):  # pragma: no cover
+        raise AssertionError('fell back to argparse')
+
+    monkeypatch.setattr(argparse.ArgumentParser, '_parse_known_args', fail)
+    args = build(FastArgumentParser).parse_args(
+        ['-v', '--tag', 'a', 'run', 'host', '--retries', '2']
+    )
+    assert args.verbose == 1
+    assert args.size == 3
+    assert args.tag == ['a']
+    assert args.command == 'run'
+    assert args.target == 'host'
+    assert args.retries == 2
+    assert args.handler == 'run'
+
+
+def test_unsupported_parsers_fall_back():
+    parser = FastArgumentParser(prog='prog')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--a', action='store_true')
+    group.add_argument('--b', action='store_true')
+    with pytest.raises(Unsupported):
+        parser._compile_fast_table()
+    assert parser.parse_args(['--a']).a is True
+
+
+@pytest.mark.parametrize(
+    'kwargs',
+    [{'action': 'extend', 'nargs': '+'}, {'nargs': 2}, {'nargs': '?'}],
+)
+def test_unsupported_actions_fall_back(kwargs):
+    parser = FastArgumentParser(prog='prog')
+    parser.add_argument('--opt', **kwargs)
+    with pytest.raises(Unsupported):
+        parser._compile_fast_table()
+    assert parser.parse_args([]).opt is None
+
+
+@pytest.mark.skipif(sys.version_info < (3, 9), reason='requires exit_on_error')
+def test_subcommand_errors_without_exit():
+    parser = FastArgumentParser(prog='prog', exit_on_error=False)
+    subparsers = parser.add_subparsers()
+    subparsers.add_parser('run').add_argument('target')
+    with pytest.raises(argparse.ArgumentError) as excinfo:
+        parser.parse_args(['run'])
+    assert 'target' in str(excinfo.value)
+
+
+def test_parser_class_option(monkeypatch):
+    monkeypatch.setattr(CLI, '_ArgumentParser', ArgumentParser)
+    app = {}
+    cli = CLI(parser_class=FastArgumentParser, context_factory=lambda cli, args: app)
+    cli.load_commands('.fixtures.foo')
+    assert isinstance(cli.compile(), FastArgumentParser)
+    assert cli.run(['foo', '--bar']) == 0
+    assert app['fn'] == 'main'
+    assert app['bar'] is True
+    # the default is unchanged
+    assert not isinstance(CLI().compile(), FastArgumentParser)
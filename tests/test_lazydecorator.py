@@ -0,0 +1,85 @@
+import types
+
+from subparse.lazydecorator import lazydecorator
+
+
+def test_discover_instance_does_not_trigger_properties():
+    dec = lazydecorator()
+
+    class Base:
+        @dec('base')
+        def base(self):  # pragma: no cover
+            pass
+
+    class Server(Base):
+        @property
+        def expensive(self):  # pragma: no cover
+            raise AssertionError('property should not be evaluated')
+
+        @dec('/index')
+        def index(self):  # pragma: no cover
+            pass
+
+        @classmethod
+        @dec('/cls')
+        def cls(cls):  # pragma: no cover
+            pass
+
+        @staticmethod
+        @dec('/static')
+        def static():  # pragma: no cover
+            pass
+
+    server = Server()
+    result = dec.discover(server)
+    assert [(func.__name__, args) for func, args, kwargs in result] == [
+        ('base', ('base',)),
+        ('index', ('/index',)),
+        ('cls', ('/cls',)),
+        ('static', ('/static',)),
+    ]
+    assert result[1][0] == server.index
+    assert result[2][0] == Server.cls
+
+
+def test_discover_module_does_not_call_getattr():
+    dec = lazydecorator()
+    module = types.ModuleType('fake')
+
+    def __getattr__(name):  # pragma: no cover
+        raise AssertionError('module __getattr__ should not be called')
+
+    @dec('a')
+    @dec('b')
+    def first():  # pragma: no cover
+        pass
+
+    @dec('c')
+    def second():  # pragma: no cover
+        pass
+
+    module.__getattr__ = __getattr__
+    module.second = second
+    module.first = first
+    module.alias = second
+    result = dec.discover(module)
+    assert [(func.__name__, args) for func, args, kwargs in result] == [
+        ('first', ('b',)),
+        ('first', ('a',)),
+        ('second', ('c',)),
+        ('second', ('c',)),
+    ]
+
+
+def test_discover_slotted_instance():
+    dec = lazydecorator()
+
+    class Slotted:
+        __slots__ = ()
+
+        @dec()
+        def method(self):  # pragma: no cover
+            pass
+
+    result = dec.discover(Slotted())
+    assert [func.__name__ for func, args, kwargs in result] == ['method']